@@ -0,0 +1,465 @@
+import os
+import time
+import random
+import resource
+from collections import deque
+import numpy as np
+from utils.utils import build_params
+from utils.dataset import Dataset
+from utils.profiling import configure as configure_profiling
+
+
+def timeit(func, repeat=20):
+    costs = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        costs.append(time.time() - start)
+    return np.median(costs)
+
+
+def bench_label(params):
+    '''
+        per-box preprocess_true_boxes vs vectorized preprocess_true_boxes_batch
+    '''
+    dataset = Dataset("train", params, pworker=0)
+    for input_size in [min(params.train_input_sizes), max(params.train_input_sizes)]:
+        output_sizes = input_size // dataset.strides
+        batch_bboxes = [dataset.parse_annotation(random.choice(dataset.annotations), input_size)[1] for _ in range(params.batch_size)]
+
+        def loop():
+            return [dataset.preprocess_true_boxes(bboxes, output_sizes) for bboxes in batch_bboxes]
+
+        def batch():
+            return dataset.preprocess_true_boxes_batch(batch_bboxes, output_sizes)
+
+        labels = list(zip(*loop()))
+        for label, label_batch in zip(labels, batch()):
+            assert np.array_equal(np.stack(label), label_batch), "label mismatch"
+
+        loop_cost, batch_cost = timeit(loop, params.bench_repeat), timeit(batch, params.bench_repeat)
+        print("label size: %d boxes: %d loop: %.3fms batch: %.3fms speedup: %.1fx" % (input_size,
+            sum(map(len, batch_bboxes)), loop_cost * 1000, batch_cost * 1000, loop_cost / batch_cost))
+
+
+def bench_augment(params):
+    '''
+        chained augmentation vs fused single-warp, samples/sec and output statistics
+    '''
+    dataset = Dataset("train", params, pworker=0)
+    input_size = max(params.train_input_sizes)
+    annotations = [random.choice(dataset.annotations) for _ in range(params.bench_repeat * 10)]
+    samples = [dataset.load_sample(annotation) for annotation in annotations]
+    dataset.load_sample = lambda idx: samples[idx]
+
+    for fused in [False, True]:
+        dataset.fused_aug = fused
+        random.seed(0)
+        start = time.time()
+        results = [dataset.parse_annotation(idx, input_size) for idx in range(len(samples))]
+        cost = time.time() - start
+        images = np.stack([image for image, _ in results])
+        boxes = np.concatenate([np.reshape(bboxes, (-1, 5)) for _, bboxes in results])
+        print("augment fused: %s samples/sec: %.1f pixel mean: %.2f std: %.2f box w: %.1f h: %.1f" % (fused,
+            len(samples) / cost, images.mean(), images.std(),
+            np.mean(boxes[:, 2] - boxes[:, 0]), np.mean(boxes[:, 3] - boxes[:, 1])))
+
+
+def assemble_batches(dataset, repeat, hold, result):
+    consumer = deque(maxlen=hold)
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    start = time.time()
+    for _ in range(repeat):
+        consumer.append(dataset.produce())
+    cost = (time.time() - start) / repeat
+    result.put((cost, start_rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.))
+
+
+def bench_dtype(params):
+    '''
+        batch assembly time and peak rss with float64 vs float32 batches. each dtype runs in
+        a forked process from the same preloaded samples, the consumer keeps the last 10 batches
+        alive like the keras generator queue
+    '''
+    import multiprocessing as mp
+
+    dataset = Dataset("train", params, pworker=0)
+    annotations = [random.choice(dataset.annotations) for _ in range(params.batch_size * 4)]
+    samples = [dataset.load_sample(annotation) for annotation in annotations]
+    dataset.annotations = np.arange(len(samples))
+    dataset.order = np.arange(len(samples))
+    dataset.num_samples = len(samples)
+    dataset.load_sample = lambda idx: samples[idx]
+
+    for dtype in [np.float64, np.float32]:
+        dataset.batch_dtype = dtype
+        result = mp.Queue()
+        worker = mp.Process(target=assemble_batches, args=(dataset, params.bench_repeat, 10, result))
+        worker.start()
+        cost, start_rss, rss = result.get()
+        worker.join()
+        print("batch dtype: %s batch assembly: %.2fms peak rss: %.1fMB (+%.1fMB while assembling)" % (
+            np.dtype(dtype).name, cost * 1000, rss, rss - start_rss))
+
+
+def bench_tfdata(params):
+    '''
+        batches/sec of the threaded generator vs Dataset.as_tf_dataset
+    '''
+    steps = params.bench_repeat * 5
+    dataset = Dataset("train", params, pworker=params.bench_workers)
+    generator = dataset.gen_iter()
+    next(generator)
+    start = time.time()
+    for _ in range(steps):
+        next(generator)
+    cost = time.time() - start
+    print("thread x%d: %.2f batches/sec" % (params.bench_workers, steps / cost))
+
+    tf_data = iter(Dataset("train", params, pworker=0).as_tf_dataset())
+    next(tf_data)
+    start = time.time()
+    for _ in range(steps):
+        next(tf_data)
+    cost = time.time() - start
+    print("tf.data: %.2f batches/sec" % (steps / cost))
+
+
+def bench_loss(params):
+    '''
+        loss_layer ignore mask against every label cell vs the compact gt list,
+        at the largest train input size, step time and max rss
+    '''
+    import tensorflow as tf
+    from train import loss_layer
+    input_size = max(params.train_input_sizes)
+    depth = 5 + params.class_num
+    for i, stride in enumerate(params.strides):
+        size = input_size // stride
+        shape = (params.batch_size, size, size, 3, depth)
+        label = np.zeros(shape, dtype=np.float32)
+        cells = np.random.randint(0, size, (params.batch_size * 10, 3))
+        label[np.repeat(np.arange(params.batch_size), 10), cells[:, 0], cells[:, 1], cells[:, 2] % 3, :5] = \
+            np.concatenate([np.random.uniform(0, input_size, (len(cells), 4)), np.ones((len(cells), 1))], axis=-1)
+        pred = np.random.uniform(0, 1, shape).astype(np.float32)
+        pred[..., :4] *= input_size
+        conv = np.random.normal(size=(params.batch_size, size, size, 3 * depth)).astype(np.float32)
+
+        results = []
+        for compact in [True, False]:
+            graph = tf.Graph()
+            with graph.as_default():
+                conv_ph = tf.compat.v1.placeholder(tf.float32, conv.shape)
+                label_ph = tf.compat.v1.placeholder(tf.float32, shape)
+                pred_ph = tf.compat.v1.placeholder(tf.float32, shape)
+                loss = loss_layer(conv_ph, params.anchors[i], stride, params.class_num,
+                                  iou_loss_thresh=params.iou_thres, compact_gt=compact)(label_ph, pred_ph)
+            with tf.compat.v1.Session(graph=graph) as sess:
+                feed = {conv_ph: conv, label_ph: label, pred_ph: pred}
+                results.append(sess.run(loss, feed))
+                cost = timeit(lambda: sess.run(loss, feed), params.bench_repeat)
+            print("loss size: %d stride: %d compact: %s step: %.2fms maxrss: %.1fMB" % (input_size, stride, compact,
+                cost * 1000, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.))
+        assert np.allclose(results[0], results[1], rtol=1e-4), "loss mismatch %s" % results
+
+
+def bench_letterbox(params):
+    '''
+        image_preporcess vs letterbox (fresh and reused buffer) on eval_ano frames at test_input
+    '''
+    import cv2
+    from utils.utils import image_preporcess, letterbox
+    from utils.annotation import AnnotationIndex
+    org_img = cv2.imread(str(AnnotationIndex.from_files(params.eval_ano).paths[0]))
+    size = [params.test_input, params.test_input]
+    for canny in [False, True]:
+        expect = image_preporcess(np.copy(org_img), size, canny=canny)
+        fast, meta = letterbox(org_img, size, canny=canny)
+        out = np.empty_like(fast)
+        diff = np.abs(expect - fast)
+        slow_cost = timeit(lambda: image_preporcess(np.copy(org_img), size, canny=canny), params.bench_repeat)
+        fast_cost = timeit(lambda: letterbox(org_img, size, canny=canny), params.bench_repeat)
+        reuse_cost = timeit(lambda: letterbox(org_img, size, out=out, canny=canny), params.bench_repeat)
+        print("letterbox %s canny: %s image_preporcess: %.2fms letterbox: %.2fms reused: %.2fms "
+              "rgb diff max %.1f mean %.3f" % (org_img.shape[:2], canny, slow_cost * 1000, fast_cost * 1000,
+              reuse_cost * 1000, diff[..., :3].max(), diff[..., :3].mean()))
+
+
+def bench_nms(params):
+    '''
+        vectorized nms / nms2 against the per pick loops, clustered candidates
+        like a low score threshold gives, results must be identical
+    '''
+    from utils.utils import nms, nms2, nms_loop, nms2_loop
+    for num in [100, 1000, 5000]:
+        centers = np.random.uniform(0, 416, (max(num // 50, 1), 2))
+        xy = centers[np.random.randint(0, len(centers), num)] + np.random.normal(0, 8, (num, 2))
+        wh = np.random.uniform(20, 120, (num, 2))
+        bboxes = np.concatenate([xy - wh / 2, xy + wh / 2, np.random.uniform(0.01, 1, (num, 1)),
+                                 np.random.randint(0, params.class_num, (num, 1))], axis=-1)
+        for method in ['nms', 'soft-nms']:
+            for func, loop in [(nms, nms_loop), (nms2, nms2_loop)]:
+                picked = func(bboxes, 0.3, method=method)
+                expect = loop(bboxes, 0.3, method=method)
+                assert len(picked) == len(expect) and np.array_equal(picked, expect), "nms mismatch"
+                fast = timeit(lambda: func(bboxes, 0.3, method=method), params.bench_repeat)
+                slow = timeit(lambda: loop(bboxes, 0.3, method=method), params.bench_repeat)
+                print("%s %s boxes: %d picks: %d loop: %.2fms vectorized: %.2fms" % (func.__name__, method,
+                    num, len(picked), slow * 1000, fast * 1000))
+
+
+def bench_quant(params):
+    '''
+        tflite variants from freeze --quantize, invoke latency at test_input and coco mAP on eval_ano
+    '''
+    import tensorflow as tf
+    from demo import run_batch, quantize_tensor, representative_dataset
+    from evaluate import GestureEval, evaluating
+    [image] = next(representative_dataset(params)())
+    gt = GestureEval(None, params=params)
+    for model_path in params.quant_models:
+        interpreter = tf.lite.Interpreter(model_path=model_path)
+        interpreter.allocate_tensors()
+        detail = interpreter.get_input_details()[0]
+        interpreter.set_tensor(detail['index'], quantize_tensor(detail, image))
+        cost = timeit(interpreter.invoke, params.bench_repeat)
+
+        params.pretrain_model = model_path
+        stats = evaluating(gt, GestureEval(run_batch(params), params))
+        print("quant %s input: %s invoke: %.2fms mAP: %.4f mAP@.5: %.4f" % (model_path, detail['dtype'].__name__,
+            cost * 1000, stats[0], stats[1]))
+
+
+def percentiles(costs):
+    costs = np.array(costs) * 1000
+    return {"mean": float(costs.mean()), "p50": float(np.percentile(costs, 50)),
+            "p90": float(np.percentile(costs, 90)), "p99": float(np.percentile(costs, 99))}
+
+
+def bench_infer(params):
+    '''
+        end to end inference per backend (bench_models, default pretrain_model), input size
+        (bench_sizes, default test_input) and batch size (bench_batches) over the first bench_images
+        of eval_ano. preprocess / inference / postprocess / nms / draw are timed per batch in ms,
+        written to bench_out, and compared with bench_baseline when set.
+    '''
+    import cv2
+    import json
+    import copy
+    from demo import predictor, draw_boxes
+    from utils.utils import letterbox, postprocess_boxes, nms
+    from utils.annotation import AnnotationIndex
+
+    paths = AnnotationIndex.from_files(params.eval_ano).paths[:params.bench_images]
+    org_imgs = [img for img in (cv2.imread(str(path)) for path in paths) if img is not None]
+    results = {}
+    for model in params.bench_models or [params.pretrain_model]:
+        for input_size in params.bench_sizes or [params.test_input]:
+            model_params = copy.copy(params)
+            model_params.pretrain_model, model_params.test_input = model, input_size
+            try:
+                predict = predictor(model_params)
+            except ValueError as e:
+                print("skip %s %d: %s" % (model, input_size, e))
+                continue
+
+            for batch_size in params.bench_batches:
+                stages = {name: [] for name in ["preprocess", "inference", "postprocess", "nms", "draw", "total"]}
+                batches = [org_imgs[i: i + batch_size] for i in range(0, len(org_imgs) - batch_size + 1, batch_size)]
+                for step, batch in enumerate(batches * (params.bench_warmup + params.bench_repeat)):
+                    costs = {}
+                    start = time.time()
+                    imgs = np.array([letterbox(img, [input_size, input_size], canny=params.canny)[0]
+                                     for img in batch], dtype=np.float32)
+                    costs["preprocess"] = time.time() - start
+
+                    start = time.time()
+                    try:
+                        preds = predict(imgs)
+                    except ValueError as e:
+                        print("skip %s %d: %s" % (model, input_size, e))
+                        break
+                    costs["inference"] = time.time() - start
+
+                    costs["postprocess"] = costs["nms"] = costs["draw"] = 0
+                    for org_img, pred_bbox in zip(batch, preds):
+                        start = time.time()
+                        bboxes = postprocess_boxes(pred_bbox, org_img.shape[:2], input_size, 0.3)
+                        costs["postprocess"] += time.time() - start
+                        start = time.time()
+                        bboxes = nms(bboxes, 0.3, method='nms')
+                        costs["nms"] += time.time() - start
+                        start = time.time()
+                        draw_boxes(params, np.copy(org_img), bboxes)
+                        costs["draw"] += time.time() - start
+
+                    if step >= len(batches) * params.bench_warmup:
+                        costs["total"] = sum(costs.values())
+                        for name, cost in costs.items():
+                            stages[name].append(cost)
+                if not stages["total"]:
+                    continue
+
+                key = "%s:%d:%d" % (os.path.basename(model.rstrip("/")), input_size, batch_size)
+                results[key] = {name: percentiles(costs) for name, costs in stages.items()}
+                results[key]["images_per_sec"] = batch_size * len(stages["total"]) / sum(stages["total"])
+                print("%s %s images/s: %.1f" % (key, " ".join(["%s p50 %.2fms" % (name, results[key][name]["p50"])
+                    for name in stages]), results[key]["images_per_sec"]))
+
+    with open(params.bench_out, "w") as fd:
+        json.dump(results, fd, indent=2)
+    print("!!!!!! %s" % params.bench_out)
+
+    if params.bench_baseline:
+        with open(params.bench_baseline) as fd:
+            baseline = json.load(fd)
+        regressions = compare_infer(baseline, results, params.bench_tolerance)
+        if regressions:
+            raise SystemExit("%d regressions against %s" % (len(regressions), params.bench_baseline))
+
+
+def compare_infer(baseline, results, tolerance=0.1, floor=0.1):
+    '''
+        a stage regresses when its p50 grows more than tolerance (relative) and floor ms
+    '''
+    regressions = []
+    for key in sorted(set(baseline) & set(results)):
+        for name, base in baseline[key].items():
+            if not isinstance(base, dict):
+                continue
+            now = results[key][name]["p50"]
+            if now > base["p50"] * (1 + tolerance) and now - base["p50"] > floor:
+                regressions.append((key, name))
+                print("REGRESSION %s %s p50 %.2fms -> %.2fms" % (key, name, base["p50"], now))
+    return regressions
+
+
+def bench_roi(params):
+    '''
+        roi re-detection (--roi_size, default 160) vs full frame on every frame of --video_source,
+        latency of both and recall against the full frame boxes (iou >= 0.5, same class)
+    '''
+    import cv2
+    from demo import model_loader, window_detector
+    from utils.tracking import RoiDetector, box_iou
+
+    detect = window_detector(model_loader(params), params)
+    roi = RoiDetector(detect, params.test_input, params.roi_size or 160, params.roi_full_interval, params.roi_expand)
+    cap = cv2.VideoCapture(params.video_source)
+    full_costs, roi_costs, hits, total = [], [], 0, 0
+    while True:
+        ret, org_img = cap.read()
+        if not ret:
+            break
+        start = time.time()
+        expect = np.array(detect(org_img, params.test_input), dtype=np.float32).reshape(-1, 6)
+        full_costs.append(time.time() - start)
+        start = time.time()
+        got = np.array(roi.step(org_img), dtype=np.float32).reshape(-1, 6)
+        roi_costs.append(time.time() - start)
+
+        total += len(expect)
+        if len(expect) and len(got):
+            iou = box_iou(expect, got) * (expect[:, None, 5] == got[None, :, 5])
+            hits += int((iou.max(axis=1) >= 0.5).sum())
+    cap.release()
+    if not full_costs:
+        raise SystemExit("no frames read from %s" % params.video_source)
+
+    full, crop = percentiles(full_costs), percentiles(roi_costs)
+    print("roi frames: %d full p50 %.2fms mean %.2fms roi p50 %.2fms mean %.2fms recall %.3f (%d / %d boxes)" % (
+        len(full_costs), full["p50"], full["mean"], crop["p50"], crop["mean"], hits / max(total, 1), hits, total))
+    roi.report()
+
+
+def bench_gate(params):
+    '''
+        motion gate (--motion_gate, default diff) on every frame of --video_source against running
+        the detector on every frame: skip ratio, cpu saved and the share of full boxes missed
+    '''
+    import cv2
+    from demo import model_loader, window_detector
+    from utils.tracking import MotionGate, box_iou
+
+    detect = window_detector(model_loader(params), params)
+    gate = MotionGate(detect, params.motion_gate or "diff", params.gate_width, params.gate_area, params.gate_diff,
+                      params.gate_roi)
+    cap = cv2.VideoCapture(params.video_source)
+    missed, total = 0, 0
+    while True:
+        ret, org_img = cap.read()
+        if not ret:
+            break
+        expect = np.array(detect(org_img), dtype=np.float32).reshape(-1, 6)
+        got = np.array(gate.step(org_img), dtype=np.float32).reshape(-1, 6)
+        total += len(expect)
+        if len(expect) and len(got):
+            iou = box_iou(expect, got) * (expect[:, None, 5] == got[None, :, 5])
+            missed += int((iou.max(axis=1) < 0.5).sum())
+        else:
+            missed += len(expect)
+    cap.release()
+    if not gate.frames:
+        raise SystemExit("no frames read from %s" % params.video_source)
+
+    gate.report()
+    print("gate missed %.3f (%d / %d full frame boxes)" % (missed / max(total, 1), missed, total))
+
+
+# share of mask pixels allowed to differ from GMMLoop
+MASK_TOLERANCE = {"loop float64": 0, "vector float64": 0, "vector float32": 1e-3}
+
+
+def bench_gmm(params):
+    '''
+        gmm.GMM per frame cost against the per pixel loops of GMMLoop on a synthetic 300x300
+        sequence (noisy static background, moving block), masks compared frame by frame.
+        float64 must match the loop exactly, float32 may flip pixels whose match / background
+        test sits on a rounding edge (MASK_TOLERANCE), the /2 model is an approximation and only reported
+    '''
+    from gmm import GMM, GMMLoop
+
+    rng = np.random.RandomState(0)
+    background = rng.randint(0, 256, (300, 300, 3)).astype(np.float32)
+    frames = []
+    for t in range(params.bench_repeat):
+        frame = np.clip(background + rng.normal(0, 3, background.shape), 0, 255).astype(np.uint8)
+        frame[100:160, t * 8 % 240:t * 8 % 240 + 60] = (200, 30, 90)
+        frames.append(frame)
+
+    models = [("loop float64", GMMLoop(300, 300, 5)), ("vector float32", GMM(300, 300, 5)),
+              ("vector float64", GMM(300, 300, 5, dtype=np.float64)), ("vector float32 /2", GMM(300, 300, 5, downscale=2))]
+    masks = {}
+    for name, model in models:
+        costs = []
+        for frame in frames:
+            start = time.time()
+            masks.setdefault(name, []).append(model.fit(frame))
+            costs.append(time.time() - start)
+        mismatch = np.mean([np.mean(a != b) for a, b in zip(masks["loop float64"], masks[name])])
+        print("gmm %s frames: %d per frame %.2fms fps %.1f mask mismatch vs loop %.5f" % (name, len(frames),
+            np.mean(costs) * 1000, 1 / np.mean(costs), mismatch))
+        if name in MASK_TOLERANCE:
+            assert mismatch <= MASK_TOLERANCE[name], "gmm %s masks differ from the loop reference" % name
+
+
+BENCHES = {
+    "label": bench_label,
+    "augment": bench_augment,
+    "dtype": bench_dtype,
+    "tfdata": bench_tfdata,
+    "loss": bench_loss,
+    "nms": bench_nms,
+    "letterbox": bench_letterbox,
+    "quant": bench_quant,
+    "infer": bench_infer,
+    "roi": bench_roi,
+    "gmm": bench_gmm,
+    "gate": bench_gate,
+}
+
+if __name__ == "__main__":
+    params = build_params()
+    configure_profiling(params)
+    for name in params.bench:
+        BENCHES[name](params)
@@ -2,7 +2,10 @@ import os
 import re
 import cv2
 import numpy as np
-from utils.utils import image_preporcess, postprocess_boxes, nms, draw_bbox, build_params, tcost
+from utils.pipeline import VideoPipeline
+from utils.interpreters import InterpreterCache
+from utils.utils import letterbox, letterbox_window, postprocess_boxes, postprocess_boxes_graph, nms, draw_bbox, build_params
+from utils.profiling import span, profiled, configure as configure_profiling
 from easydict import EasyDict as easydict
 from tensorflow.keras.optimizers import Adam
 import tensorflow as tf
@@ -12,7 +15,7 @@ from train import build_model
 
 def draw_boxes(params, org_img, bboxes):
     for bb in bboxes:
-        bb = bb.astype(np.int)
+        bb = bb.astype(int)
         b1, b2 = tuple(bb[:2]), tuple(bb[2:4])
         cate_id = bb[5]
 
@@ -23,19 +26,25 @@ def draw_boxes(params, org_img, bboxes):
 def checkpoint_loader(params):
     models = build_model(params)
 
-    @tcost
-    def run_result(org_img, input_size, params):
+    @profiled("checkpoint_loader")
+    def run_result(org_img, input_size, params, img=None, draw=True, meta=None):
         original_image_size = org_img.shape[:2]
-        img = image_preporcess(np.copy(org_img), [input_size, input_size], canny=params.canny)
-        pred_mbbox, pred_lbbox = models.predict(np.array([img]))
+        if img is None:
+            with span("preprocess"):
+                img, meta = letterbox(org_img, [input_size, input_size], canny=params.canny)
+        with span("inference"):
+            pred_mbbox, pred_lbbox = models.predict(np.array([img]))
         pred_bbox = np.concatenate([
             np.reshape(pred_mbbox, (-1, 5 + params.class_num)),
             np.reshape(pred_lbbox, (-1, 5 + params.class_num))
         ], axis=0)
 
-        bboxes = postprocess_boxes(pred_bbox, original_image_size, input_size, 0.3)
-        bboxes = nms(bboxes, 0.3, method='nms')
-        draw_boxes(params, org_img, bboxes)
+        bboxes = postprocess_boxes(pred_bbox, original_image_size, input_size, 0.3, meta)
+        with span("nms"):
+            bboxes = nms(bboxes, 0.3, method='nms')
+        if draw:
+            with span("draw"):
+                draw_boxes(params, org_img, bboxes)
 
         return bboxes
     return run_result
@@ -46,52 +55,99 @@ def pb_loader(params):
     graph = tf.Graph() 
     pb_file = params.pretrain_model  # "./test/test.pb"
     return_elements = ["input_1:0", "branch/mid:0", "branch/large:0"]
+    if params.export_nms:
+        return_elements = ["input_1:0", "org_shape:0", "postprocess/detections:0", "postprocess/valid:0"]
     rtensor = read_pb_return_tensors(graph, pb_file, return_elements)
     print(rtensor)
     sess = tf.compat.v1.Session(graph=graph)
 
-    @tcost
-    def run_result(org_img, input_size, params):
+    @profiled("pb_loader")
+    def run_result(org_img, input_size, params, img=None, draw=True, meta=None):
         original_image_size = org_img.shape[:2]
-        img = image_preporcess(np.copy(org_img), [input_size, input_size], canny=params.canny)
-        pred_mbbox, pred_lbbox = sess.run(rtensor[1:], feed_dict={rtensor[0]: [img]})
+        if img is None:
+            with span("preprocess"):
+                img, meta = letterbox(org_img, [input_size, input_size], canny=params.canny)
+        if params.export_nms:
+            with span("inference"):
+                detections, valid = sess.run(rtensor[2:], feed_dict={rtensor[0]: [img], rtensor[1]: original_image_size})
+            bboxes = list(detections[:valid])
+            if draw:
+                with span("draw"):
+                    draw_boxes(params, org_img, bboxes)
+            return bboxes
+
+        with span("inference"):
+            pred_mbbox, pred_lbbox = sess.run(rtensor[1:], feed_dict={rtensor[0]: [img]})
         pred_bbox = np.concatenate([
             np.reshape(pred_mbbox, (-1, 5 + params.class_num)),
             np.reshape(pred_lbbox, (-1, 5 + params.class_num))], axis=0)
 
-        bboxes = postprocess_boxes(pred_bbox, original_image_size, input_size, 0.3)
-        bboxes = nms(bboxes, 0.3, method='nms')
-        draw_boxes(params, org_img, bboxes)
+        bboxes = postprocess_boxes(pred_bbox, original_image_size, input_size, 0.3, meta)
+        with span("nms"):
+            bboxes = nms(bboxes, 0.3, method='nms')
+        if draw:
+            with span("draw"):
+                draw_boxes(params, org_img, bboxes)
         return bboxes
 
 
     return run_result
 
+def quantize_tensor(detail, data):
+    '''
+        float data -> dtype of an interpreter input, int8 / uint8 inputs use its (scale, zero_point)
+    '''
+    data = np.asarray(data, dtype=np.float32)
+    if detail['dtype'] in (np.int8, np.uint8):
+        scale, zero_point = detail['quantization']
+        info = np.iinfo(detail['dtype'])
+        data = np.clip(np.round(data / scale + zero_point), info.min, info.max)
+    return data.astype(detail['dtype'])
+
+def dequantize_tensor(detail, data):
+    if detail['dtype'] in (np.int8, np.uint8):
+        scale, zero_point = detail['quantization']
+        return (data.astype(np.float32) - zero_point) * scale
+    return data
+
 def tflite_loader(params):
     print("tf - lloader")
-    interpreter = tf.lite.Interpreter(model_path=params.pretrain_model)
-    interpreter.allocate_tensors()
-
-    # 获取输入和输出张量。
-    input_details = interpreter.get_input_details()
-    [merge_branch] = interpreter.get_output_details()
-    print(input_details)
-
-    @tcost
-    def run_result(org_img, input_size, params):
-        original_image_size = org_img.shape[:2]
-        img = image_preporcess(np.copy(org_img), [input_size, input_size], canny=params.canny)
-
-        input_data = [img.astype(np.float32)]
-        interpreter.set_tensor(input_details[0]['index'], input_data)
-        interpreter.invoke()
-        bboxes = interpreter.get_tensor(merge_branch["index"])
-
-        pred_bbox = np.reshape(bboxes, (-1, 5 + params.class_num))
-
-        bboxes = postprocess_boxes(pred_bbox, original_image_size, input_size, 0.3)
-        bboxes = nms(bboxes, 0.3, method='nms')
-        draw_boxes(params, org_img, bboxes)
+    # one allocated interpreter per input size, resized from a --tflite_dynamic export
+    cache = InterpreterCache(params.pretrain_model, capacity=params.tflite_cache)
+    cache.warmup(params.warmup_sizes or [params.test_input])
+    print(cache.get(params.test_input).inputs)
+
+    @profiled("tflite_loader")
+    def run_result(org_img, input_size, params, img=None, draw=True, org_shape=None, meta=None):
+        original_image_size = org_img.shape[:2] if org_shape is None else org_shape
+        if img is None:
+            with span("preprocess"):
+                img, meta = letterbox(org_img, [input_size, input_size], canny=params.canny)
+
+        entry = cache.get(input_size)
+        interpreter, input_details = entry.interpreter, entry.inputs
+        input_data = quantize_tensor(input_details[0], [img])
+        with entry.lock, span("inference"):
+            interpreter.set_tensor(input_details[0]['index'], input_data)
+            if params.export_nms:
+                detections, valid = entry.outputs
+                interpreter.set_tensor(input_details[1]['index'], np.array(original_image_size, dtype=np.int32))
+                interpreter.invoke()
+                valid_num = int(interpreter.get_tensor(valid["index"]))
+                bboxes = list(interpreter.get_tensor(detections["index"])[:valid_num])
+            else:
+                [merge_branch] = entry.outputs
+                interpreter.invoke()
+                bboxes = dequantize_tensor(merge_branch, interpreter.get_tensor(merge_branch["index"]))
+
+        if not params.export_nms:
+            pred_bbox = np.reshape(bboxes, (-1, 5 + params.class_num))
+            bboxes = postprocess_boxes(pred_bbox, original_image_size, input_size, 0.3, meta)
+            with span("nms"):
+                bboxes = nms(bboxes, 0.3, method='nms')
+        if draw:
+            with span("draw"):
+                draw_boxes(params, org_img, bboxes)
         return bboxes
     return run_result
 
@@ -114,22 +170,194 @@ def run_test(params):
     print("!!!", result)
     cv2.imwrite("test_gg.jpg", org_img)
 
+def predictor(params):
+    '''
+        raw model output for a batch of letterboxed images, predict(imgs) -> (batch, n, 5 + class_num)
+        before postprocess_boxes / nms. tflite runs the batch-1 interpreter image by image.
+    '''
+    if params.pretrain_model.find("tflite") != -1:
+        if params.export_nms:
+            raise ValueError("export_nms tflite has no raw predictions")
+        cache = InterpreterCache(params.pretrain_model, capacity=params.tflite_cache)
+
+        def predict(imgs):
+            preds = []
+            for img in imgs:
+                entry = cache.get(img.shape[0])
+                [merge_branch] = entry.outputs
+                input_data = quantize_tensor(entry.inputs[0], [img])
+                with entry.lock:
+                    entry.interpreter.set_tensor(entry.inputs[0]['index'], input_data)
+                    entry.interpreter.invoke()
+                    preds.append(dequantize_tensor(merge_branch, entry.interpreter.get_tensor(merge_branch["index"])))
+            return np.reshape(preds, (len(imgs), -1, 5 + params.class_num))
+        return predict
+    elif params.pretrain_model.find("pb") != -1:
+        graph = tf.Graph()
+        rtensor = read_pb_return_tensors(graph, params.pretrain_model, ["input_1:0", "branch/mid:0", "branch/large:0"])
+        sess = tf.compat.v1.Session(graph=graph)
+        predict_branch = lambda imgs: sess.run(rtensor[1:], feed_dict={rtensor[0]: imgs})
+    else:
+        models = build_model(params)
+        predict_branch = models.predict_on_batch
+
+    def predict(imgs):
+        pred_mbbox, pred_lbbox = predict_branch(imgs)
+        return np.concatenate([
+            np.reshape(pred_mbbox, (len(imgs), -1, 5 + params.class_num)),
+            np.reshape(pred_lbbox, (len(imgs), -1, 5 + params.class_num))], axis=1)
+    return predict
+
+
+def batch_loader(params):
+    '''
+        batched inference, run_result(imgs, org_shapes, input_size, params, metas) -> bboxes per image,
+        metas are the letterbox (scale, dw, dh) of each image
+    '''
+    if params.pretrain_model.find("tflite") != -1 and params.export_nms:
+        proc = tflite_loader(params)
+        return lambda imgs, org_shapes, input_size, params, metas: [proc(None, input_size, params, img=img, draw=False,
+            org_shape=org_shape, meta=meta) for img, org_shape, meta in zip(imgs, org_shapes, metas)]
+    predict = predictor(params)
+
+    def run_result(imgs, org_shapes, input_size, params, metas):
+        result = []
+        for pred_bbox, original_image_size, meta in zip(predict(imgs), org_shapes, metas):
+            bboxes = postprocess_boxes(pred_bbox, original_image_size, input_size, 0.3, meta)
+            result.append(nms(bboxes, 0.3, method='nms'))
+        return result
+    return run_result
+
+
+def image_id(fpath):
+    return int(re.search("\d+", str(fpath)).group(0))
+
+
+def load_image(fpath, input_size, params):
+    org_img = cv2.imread(str(fpath))
+    if org_img is None:
+        raise KeyError("can not read %s" % fpath)
+    img, meta = letterbox(org_img, [input_size, input_size], canny=params.canny)
+    return org_img if params.render_dir else None, org_img.shape[:2], img, meta
+
+
+def render(params, fpath, org_img, bboxes):
+    draw_boxes(params, org_img, bboxes)
+    cv2.imwrite(os.path.join(params.render_dir, os.path.basename(str(fpath))), org_img)
+
+
+_tflite_worker = {}
+
+def tflite_worker_init(params):
+    _tflite_worker["params"] = params
+    _tflite_worker["proc"] = tflite_loader(params)
+
+def tflite_worker(fpath):
+    params = _tflite_worker["params"]
+    org_img, org_shape, img, meta = load_image(fpath, params.test_input, params)
+    bboxes = _tflite_worker["proc"](org_img, params.test_input, params, img=img, draw=False, org_shape=org_shape, meta=meta)
+    if params.render_dir:
+        render(params, fpath, org_img, bboxes)
+    return fpath, bboxes
+
+
 def run_batch(params):
+    '''
+        offline inference over eval_ano: images are decoded and letterboxed by a thread pool
+        and run in fixed size batches (keras / pb, last batch padded), tflite runs a process
+        pool of batch-1 interpreters. rows [img_id, x1, y1, x2, y2, score, cid] stream to
+        detections_out as float32 when set.
+    '''
+    from multiprocessing import Pool
+    from multiprocessing.pool import ThreadPool
+    from collections import deque
+    from utils.annotation import AnnotationIndex
+
     result = []
-    proc = model_loader(params) 
-
-    for root, _, files in os.walk("./data/test"):
-        for f in files:
-            fpath = os.path.join(root, f)
-            org_img = img = cv2.imread(fpath)
-            input_size = params.test_input
-            img_id = int(re.search("\d+", fpath).group(0))
-            bboxes = proc(org_img, input_size, params)
-            for bb in bboxes:
-                result.append([img_id, int(bb[0]), int(bb[1]), int(bb[2]), int(bb[3]), int(bb[4]), int(bb[5])]) 
+    paths = AnnotationIndex.from_files(params.eval_ano).paths
+    input_size = params.test_input
+    batch_size = params.infer_batch
+    writer = open(params.detections_out, "wb") if params.detections_out else None
+    if params.render_dir:
+        os.makedirs(params.render_dir, exist_ok=True)
+
+    def emit(fpath, bboxes):
+        img_id = image_id(fpath)
+        rows = [[img_id] + list(bb[:6]) for bb in bboxes]
+        if writer is not None and rows:
+            np.array(rows, dtype=np.float32).tofile(writer)
+        for row in rows:
+            result.append([int(v) for v in row])
+
+    if params.pretrain_model.find("tflite") != -1:
+        with Pool(params.infer_workers, initializer=tflite_worker_init, initargs=(params,)) as pool:
+            for fpath, bboxes in pool.imap(tflite_worker, paths, chunksize=batch_size):
+                emit(fpath, bboxes)
+    else:
+        proc = batch_loader(params)
+
+        def infer(batch, loaded):
+            org_imgs, org_shapes, imgs, metas = zip(*loaded.get())
+            imgs = np.array(imgs + imgs[-1:] * (batch_size - len(imgs)), dtype=np.float32)
+            for fpath, org_img, bboxes in zip(batch, org_imgs, proc(imgs, org_shapes, input_size, params, metas)):
+                if params.render_dir:
+                    render(params, fpath, org_img, bboxes)
+                emit(fpath, bboxes)
+
+        # at most infer_workers decoded batches wait for the model
+        pending = deque()
+        with ThreadPool(params.infer_workers) as pool:
+            for start in range(0, len(paths), batch_size):
+                batch = paths[start: start + batch_size]
+                pending.append((batch, pool.map_async(lambda fpath: load_image(fpath, input_size, params), batch)))
+                if len(pending) > params.infer_workers:
+                    infer(*pending.popleft())
+            while pending:
+                infer(*pending.popleft())
+
+    if writer is not None:
+        writer.close()
     return np.array(result)
 
 
+def representative_dataset(params):
+    '''
+        calibration images for full integer quantization, Dataset("test") letterboxed at test_input
+    '''
+    from utils.dataset import Dataset
+    dataset = Dataset("test", params, pworker=0)
+
+    def gen():
+        for annotation in dataset.annotations[:params.calib_num]:
+            image, _ = dataset.parse_annotation(annotation, params.test_input)
+            yield [image[np.newaxis].astype(np.float32)]
+    return gen
+
+
+def quantize_converter(converter, params):
+    '''
+        none: float32, dynamic: int8 weights / float kernels, float16: fp16 weights,
+        int8 / uint8: int8 kernels and int8 / uint8 input, calibrated on the test set.
+        export_nms keeps float outputs, nms has no integer kernel.
+        :return: tflite file name
+    '''
+    if params.quantize == "none":
+        return "gesture_float.tflite"
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if params.quantize == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif params.quantize in ["int8", "uint8"]:
+        io_type = tf.int8 if params.quantize == "int8" else tf.uint8
+        converter.representative_dataset = representative_dataset(params)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = io_type
+        if params.export_nms:
+            converter.target_spec.supported_ops.append(tf.lite.OpsSet.TFLITE_BUILTINS)
+        else:
+            converter.inference_output_type = io_type
+    return "gesture.tflite" if params.quantize == "dynamic" else "gesture_%s.tflite" % params.quantize
+
+
 def freezon_graph(params):
     # from tensorflow.python.framework.graph_util import convert_variables_to_constants
     # https://github.com/tensorflow/tensorflow/issues/31331
@@ -149,29 +377,45 @@ def freezon_graph(params):
     print(model.outputs, model.inputs)
     # unfriendly ops: tf.newaxis, dims more than 4
     mid, lge = model.outputs
+    inputs, outputs = model.inputs, [mid, lge]
     if params.tflite:
-        mid = tf.reshape(mid, (tf.shape(mid)[0], -1, tf.shape(mid)[-1],)) 
-        lge = tf.reshape(lge, (tf.shape(lge)[0], -1, tf.shape(lge)[-1],)) 
-        merge_branch = tf.concat([mid, lge], axis=1)
+        input_size = None if params.tflite_dynamic else params.test_input
+        model.inputs[0].set_shape([1, input_size, input_size, params.channel])
+    if params.export_nms:
+        # single image graph returning at most max_output boxes in original image coordinates
+        org_shape = tf.compat.v1.placeholder(tf.int32, [2], name="org_shape")
+        with tf.name_scope("postprocess"):
+            pred_bbox = tf.concat([tf.reshape(mid[0], (-1, 5 + params.class_num)),
+                                   tf.reshape(lge[0], (-1, 5 + params.class_num))], axis=0)
+            detections, valid = postprocess_boxes_graph(pred_bbox, org_shape, tf.shape(model.inputs[0])[1],
+                                                        params.thres, params.nms_thres, params.max_output)
+            detections = tf.identity(detections, name="detections")
+            valid = tf.identity(valid, name="valid")
+        inputs, outputs = [model.inputs[0], org_shape], [detections, valid]
+
+    if params.tflite:
+        if not params.export_nms:
+            mid = tf.reshape(mid, (tf.shape(mid)[0], -1, tf.shape(mid)[-1],)) 
+            lge = tf.reshape(lge, (tf.shape(lge)[0], -1, tf.shape(lge)[-1],)) 
+            outputs = [tf.concat([mid, lge], axis=1)]
         
-        model.inputs[0].set_shape([1, params.test_input, params.test_input, 3])
-        converter = tf.compat.v1.lite.TFLiteConverter.from_session(sess, model.inputs, [merge_branch])
-        converter.optimizations = [tf.lite.Optimize.DEFAULT]
-        #converter.target_spec.supported_types = [tf.compat.v1.lite.constants.FLOAT16]
+        converter = tf.compat.v1.lite.TFLiteConverter.from_session(sess, inputs, outputs)
+        tflite_file = quantize_converter(converter, params)
         tflite_model = converter.convert()
-        open("gesture.tflite", "wb").write(tflite_model)
+        open(tflite_file, "wb").write(tflite_model)
+        print("!!!!!! %s %s" % (params.quantize, tflite_file))
         return
 
     tf.compat.v1.saved_model.simple_save(K.get_session(),
         outdir,
-        inputs={"input": model.inputs[0]},
-        outputs={"output0": mid, "output1": lge})
+        inputs=dict(zip(["input", "org_shape"], inputs)),
+        outputs={"output%d" % i: tensor for i, tensor in enumerate(outputs)})
 
     freeze_graph.freeze_graph(None,
         None,
         None,
         None,
-        mid.op.name + "," + lge.op.name,
+        ",".join([tensor.op.name for tensor in outputs]),
         None,
         None,
         os.path.join(outdir, pb_file),
@@ -193,8 +437,102 @@ def read_pb_return_tensors(graph, pb_file, return_elements):
     return return_elements
 
 
+def open_source(params):
+    source = params.video_source
+    return cv2.VideoCapture(int(source) if source.isdigit() else source)
+
+
+def video_pipeline(params):
+    cap = open_source(params)
+    proc = model_loader(params)
+    input_size = params.test_input
+
+    def preprocess(frame):
+        frame.img, frame.meta = letterbox(frame.org_img, [input_size, input_size], canny=params.canny)
+        return frame
+
+    def infer(frame):
+        frame.bboxes = proc(frame.org_img, input_size, params, img=frame.img, draw=False, meta=frame.meta)
+        return frame
+
+    def render(frame):
+        draw_boxes(params, frame.org_img, frame.bboxes)
+        if params.no_show:
+            return True
+        cv2.imshow("camera", frame.org_img)
+        return cv2.waitKey(1) & 0xFF != ord('q')
+
+    # files are paced at their fps so frames get dropped the way a camera would
+    VideoPipeline(cap, preprocess, infer, render, realtime=not params.video_source.isdigit()).run()
+    cap.release()
+
+
+def window_detector(proc, params):
+    '''
+        detect(org_img, input_size, window=None) for utils.tracking. a window (x0, y0, x1, y1) runs the
+        model on that crop only, its letterbox meta carries the offset so postprocess_boxes returns
+        boxes clipped to org_img. export_nms models postprocess in the graph against the crop shape,
+        their boxes are shifted and clipped to org_img here.
+    '''
+    def detect(org_img, input_size=params.test_input, window=None):
+        if window is None:
+            return proc(org_img, input_size, params, draw=False)
+        if params.export_nms:
+            x0, y0, x1, y1 = window
+            bboxes = np.array(proc(org_img[y0:y1, x0:x1], input_size, params, draw=False), dtype=np.float32).reshape(-1, 6)
+            bboxes[:, [0, 2]] = np.clip(bboxes[:, [0, 2]] + x0, 0, org_img.shape[1] - 1)
+            bboxes[:, [1, 3]] = np.clip(bboxes[:, [1, 3]] + y0, 0, org_img.shape[0] - 1)
+            return list(bboxes)
+        img, meta = letterbox_window(org_img, window, [input_size, input_size], canny=params.canny)
+        return proc(org_img, input_size, params, img=img, meta=meta, draw=False)
+    return detect
+
+
+def video_stepper(params):
+    '''
+        --roi_size: detector on crops around the last hands, --track: detector on keyframes only,
+        --motion_gate: nothing runs on static frames. Combined they nest gate -> track -> roi.
+    '''
+    from utils.tracking import DetectTracker, RoiDetector, MotionGate
+
+    cap = open_source(params)
+    proc = model_loader(params)
+    detect = window_detector(proc, params)
+    steppers = []
+    if params.roi_size:
+        steppers.append(RoiDetector(detect, params.test_input, params.roi_size, params.roi_full_interval, params.roi_expand))
+        detect = steppers[-1].step
+    if params.track:
+        steppers.append(DetectTracker(detect, params.track_interval_min, params.track_interval_max,
+            params.track_min_conf, params.track_motion))
+    if params.motion_gate:
+        # cropping only makes sense right in front of the detector
+        steppers.append(MotionGate(steppers[-1].step if steppers else detect, params.motion_gate, params.gate_width,
+            params.gate_area, params.gate_diff, roi=params.gate_roi and not steppers))
+
+    while(True):
+        ret, org_img = cap.read()
+        if not ret:
+            break
+        bboxes = steppers[-1].step(org_img)
+        draw_boxes(params, org_img, bboxes)
+
+        if not params.no_show:
+            cv2.imshow("camera", org_img)
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+    cap.release()
+    for stepper in steppers:
+        stepper.report()
+
+
 def video(params):
-    cap = cv2.VideoCapture(0)
+    if params.track or params.roi_size or params.motion_gate:
+        return video_stepper(params)
+    if params.pipeline:
+        return video_pipeline(params)
+
+    cap = open_source(params)
     proc = model_loader(params)
     input_size = params.test_input
 
@@ -206,12 +544,28 @@ def video(params):
 
         proc(org_img, input_size, params)
 
-        cv2.imshow("camera", org_img)
-        cv2.waitKey(1)
+        if not params.no_show:
+            cv2.imshow("camera", org_img)
+            cv2.waitKey(1)
+
+
+def serve(params):
+    from utils.server import build_server
+
+    proc = batch_loader(params)
+    input_size = params.test_input
+    server = build_server(params.serve_address, lambda imgs, org_shapes, metas: proc(imgs, org_shapes, input_size, params, metas),
+        input_size, canny=params.canny, window=params.batch_window / 1000., max_batch=params.serve_batch)
+    print("serving on %s" % params.serve_address)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
 
 
 if __name__ == "__main__":
     params = build_params()
+    configure_profiling(params)
     if params.mode == "test":
         run_test(params)
     elif params.mode == "freeze":
@@ -219,5 +573,7 @@ if __name__ == "__main__":
         #print(pb_loader(params))
     elif params.mode == "batch":
         run_batch(params)
+    elif params.mode == "serve":
+        serve(params)
     else:
         video(params)
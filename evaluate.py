@@ -4,6 +4,7 @@ from pycocotools.coco import COCO
 from pycocotools.cocoeval import COCOeval, Params
 from demo import run_batch
 from utils.utils import build_params, config_gpu 
+from utils.annotation import AnnotationIndex
 
 class GestureEval(COCO):
 
@@ -20,29 +21,21 @@ class GestureEval(COCO):
         '''
            hack function
            ano: type == str, the formation of anotation file meets demands which is "../XX/XX/\d+.jpg x1,y1,x2,y2,cid x1,y1x2,y2,cid ...."
+                or "x1,y1,x2,y2,score,cid" boxes for detections
                 type = np.array NX7 [imageid, x1, y1, x2,y2, prob, cid]
         '''
         if isinstance(ano, str):
-            result = []
-            with open(ano) as fd:
-                lines = fd.readlines()
-                for line in lines:
-                    sp = line.strip().split(" ")
-                    fpath, locs = sp[0], sp[1:]
-                    mtc = re.search("\d+", fpath)
-                    image_id = int(mtc.group(0)) if mtc else None 
-                    if image_id == None:
-                        raise Exception("image id must be a integer")
-
-                    for loc in locs:
-                        elm = list(map(int ,loc.split(",")))
-                        if len(elm) == 5:
-                            x1, y1, x2, y2, cid, score = elm + [1]
-                        elif elm == 6:
-                            x1, y1, x2, y2, score, cid = elm
-
-                        result.append([image_id, x1, y1, x2, y2, score, cid])
-                result =  np.array(result)
+            index = AnnotationIndex.from_files(ano)
+            image_ids = []
+            for fpath in index.paths:
+                mtc = re.search("\d+", str(fpath))
+                if mtc is None:
+                    raise Exception("image id must be a integer")
+                image_ids.append(int(mtc.group(0)))
+            box_image_ids = np.array(image_ids)[index.path_ids][index.box_sample_ids()]
+            boxes = index.boxes
+            result = np.stack([box_image_ids, boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3],
+                               index.scores, boxes[:, 4]], axis=-1)
         elif type(ano) == np.ndarray:
             result = ano
         else:
@@ -57,6 +50,7 @@ def evaluating(cocoGt, cocoDt):
     handler.evaluate()
     handler.accumulate()
     handler.summarize()
+    return handler.stats
 
 
 if __name__ == "__main__":
@@ -16,16 +16,32 @@ def cost(func):
     return __wrap__
     
 
-class GMM:
+def channel_sum(x):
+    total = x[..., 0].copy()
+    for i in range(1, x.shape[-1]):
+        total += x[..., i]
+    return total
 
-    def __init__(self, height, width, model_per_pixl, channel=3):
+
+class GMM:
+    '''
+        per pixel mixture of model_per_pixl gaussians, fit(img) -> foreground mask.
+        every update is a whole-array op: the matched component of each pixel is picked with
+        argmax / take_along_axis and updated through boolean masks, pixels without a match
+        replace their last (lowest weight) component. State is dtype (float32 by default),
+        downscale > 1 fits a resized frame and hands back a mask at the input size.
+    '''
+
+    def __init__(self, height, width, model_per_pixl, channel=3, dtype=np.float32, downscale=1):
         self.k = model_per_pixl
         self.channel = channel
-        self.height, self.width = height, width
-        self.means = np.zeros([height, width, model_per_pixl, channel], np.float64)
-        self.variance = np.ones([height, width, model_per_pixl, channel])
-        self.omega = np.ones([height, width, model_per_pixl]) / model_per_pixl  # model_wight 
-        self.rol = np.zeros([height, width, model_per_pixl]) 
+        self.dtype = dtype
+        self.downscale = downscale
+        self.height, self.width = height // downscale, width // downscale
+        self.means = np.zeros([self.height, self.width, model_per_pixl, channel], dtype)
+        self.variance = np.ones([self.height, self.width, model_per_pixl, channel], dtype)
+        self.omega = np.ones([self.height, self.width, model_per_pixl], dtype) / model_per_pixl  # model_wight 
+        self.rol = np.zeros([self.height, self.width, model_per_pixl], dtype) 
 
         self.lr = self.alpha = 0.05
         self.init_weight = 0.1
@@ -35,14 +51,86 @@ class GMM:
     def norm_weight(self):
         self.omega = self.omega /np.sum(self.omega, axis=-1)[..., np.newaxis]
 
-    @cost
     def pdf(self, img):
         # 多维高斯分布
         exp = -0.5 * np.sum(np.power(img - self.means, 2) / self.variance, axis=-1)
         c = np.power(2 * np.pi * np.sum(self.variance, axis=-1), self.channel / 2)
         return 1 / c * np.exp(exp)
 
-    @cost
+    def resorted(self):
+        # only pixels whose weights went out of order move, the rest keep the identity permutation
+        unsorted = np.flatnonzero((self.omega[..., 1:] > self.omega[..., :-1]).any(axis=-1))
+        if not len(unsorted):
+            return
+        omega = self.omega.reshape(-1, self.k)
+        perm = np.argsort(-omega[unsorted], axis=-1)  # 降序
+        index = (unsorted[:, np.newaxis] * self.k + perm).ravel()
+        for state in [self.omega, self.means, self.variance]:
+            flat = state.reshape(-1, self.k, *state.shape[3:])
+            flat[unsorted] = state.reshape(len(omega) * self.k, -1)[index].reshape(flat[unsorted].shape)
+
+    def background_mask(self, T=0.3):
+        cum_weight = np.cumsum(self.omega, axis=-1)
+        return cum_weight < T
+
+    def fit(self, img):
+        org_shape = img.shape[:2]
+        if self.downscale > 1:
+            img = cv2.resize(img, (self.width, self.height), interpolation=cv2.INTER_AREA)
+        img = img.astype(self.dtype)
+        update_var = (img[:, :, np.newaxis, :] - self.means) ** 2
+        # squared mahalanobis distance, shared by the pdf and the 2.5 sigma test
+        # channel sums unrolled, np.sum over a short last axis is the slowest op here
+        distance = channel_sum(update_var / self.variance)
+        c = np.power(2 * np.pi * channel_sum(self.variance), self.channel / 2)
+        self.rol = self.alpha * (1 / c * np.exp(-0.5 * distance))
+
+        bgd_delta = np.sqrt(distance)
+        bgd_mask = bgd_delta < 2.5
+        result = np.any(bgd_mask & self.background_mask(), axis=-1)
+        self.count += 1
+
+        self.alpha = 0.1 if self.count < 10 else 0.0001
+
+        # candidate per pixel: the last component with a non zero distance
+        nonzero = bgd_delta != 0
+        candidate = self.k - 1 - np.argmax(nonzero[..., ::-1], axis=-1)
+        matched = nonzero.any(axis=-1) & np.take_along_axis(bgd_mask, candidate[..., np.newaxis], axis=-1)[..., 0]
+
+        # flat views: pixel p, component i -> row p * k + i
+        pixels = img.reshape(-1, self.channel)
+        omega, rol = self.omega.reshape(-1), self.rol.reshape(-1)
+        means, variance = self.means.reshape(-1, self.channel), self.variance.reshape(-1, self.channel)
+
+        omega *= (1 - self.alpha)
+        hit = np.flatnonzero(matched)
+        index = hit * self.k + candidate.reshape(-1)[hit]
+        omega[index] += self.alpha  # update weight
+        means[index] += rol[index, np.newaxis] * (pixels[hit] - means[index])
+        variance[index] += rol[index, np.newaxis] * (update_var.reshape(-1, self.channel)[index] - variance[index])
+
+        # 都不是backgound
+        miss = np.flatnonzero(~matched)
+        index = miss * self.k + self.k - 1
+        omega[index] = self.init_weight
+        means[index] = pixels[miss]
+        variance[index] = self.max_var
+
+        self.norm_weight()
+        self.resorted()
+        if self.downscale > 1:
+            result = cv2.resize(result.astype(np.uint8), org_shape[::-1], interpolation=cv2.INTER_NEAREST).astype(bool)
+        return result
+
+
+class GMMLoop(GMM):
+    '''
+        the original per pixel loops, float64, kept as the reference for GMM
+    '''
+
+    def __init__(self, height, width, model_per_pixl, channel=3):
+        GMM.__init__(self, height, width, model_per_pixl, channel, dtype=np.float64)
+
     def resorted(self):
         sort_idx = np.argsort(-self.omega, axis=-1)
         for r in range(self.height):
@@ -52,13 +140,6 @@ class GMM:
                 self.means[r, c] = self.means[r, c, perm]
                 self.variance[r, c] = self.variance[r, c, perm]
 
-    @cost
-    def background_mask(self, T=0.3):
-        cum_weight = np.cumsum(self.omega, axis=-1)
-        return cum_weight < T
-
-
-    @cost
     def fit(self, img):
         new_img = np.tile(img[:,:, np.newaxis,:], [1, 1, self.k, 1])
         self.rol = self.alpha * self.pdf(new_img)
@@ -70,7 +151,6 @@ class GMM:
         self.count += 1
         
         self.alpha = 0.1 if self.count < 10 else 0.0001
-        print(self.alpha)
 
         # update omega
         # min_dis_index = np.argmin(bgd_delta, axis=-1)
@@ -106,10 +186,13 @@ def main():
     gm = GMM(height, width, 5, channel)
     while(True):
         _, img = cap.read()
-        mask = gm.fit(img)
+        mask = cost(gm.fit)(img)
         print(mask.shape, img.shape)
         mask = cv2.medianBlur(mask.astype(np.uint8), 5)
-        img[mask.astype(np.bool)] = (255, 255, 255)
+        img[mask.astype(bool)] = (255, 255, 255)
         cv2.imshow("test", img)
         cv2.waitKey(100)
-main()
+
+
+if __name__ == "__main__":
+    main()
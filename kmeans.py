@@ -1,104 +1,172 @@
 import numpy as np
 import cv2
 import os
+from utils.annotation import AnnotationIndex
 
 
-class YOLO_Kmeans:
+'''
+    anchor clustering with 1 - iou as the distance:
+        k-means++ seeding, lloyd steps with dist (median) updates, mini-batch mean updates once
+        there are more than batch_size boxes, restarts run in worker processes, best avg iou wins.
+    txt2clusters writes anchors.txt in the --anchors_path format: per stride, anchors_per_scale
+    (w, h) pairs in grid units.
+'''
+_worker_boxes = None
 
-    def __init__(self, cluster_number, filename):
-        self.cluster_number = cluster_number
-        self.filename = filename
 
-    def iou(self, boxes, clusters):  # 1 box -> k clusters
-        n = boxes.shape[0]
-        k = self.cluster_number
+def kmeans_worker_init(boxes):
+    global _worker_boxes
+    _worker_boxes = boxes
 
-        box_area = boxes[:, 0] * boxes[:, 1]
-        box_area = box_area.repeat(k)
-        box_area = np.reshape(box_area, (n, k))
 
-        cluster_area = clusters[:, 0] * clusters[:, 1]
-        cluster_area = np.tile(cluster_area, [1, n])
-        cluster_area = np.reshape(cluster_area, (n, k))
+def kmeans_worker(args):
+    cluster_number, seed, batch_size, max_iter = args
+    kmeans = YOLO_Kmeans(cluster_number, None)
+    clusters = kmeans.kmeans(_worker_boxes, cluster_number, seed=seed, batch_size=batch_size, max_iter=max_iter)
+    return clusters, kmeans.avg_iou(_worker_boxes, clusters)
 
-        box_w_matrix = np.reshape(boxes[:, 0].repeat(k), (n, k))
-        cluster_w_matrix = np.reshape(np.tile(clusters[:, 0], (1, n)), (n, k))
-        min_w_matrix = np.minimum(cluster_w_matrix, box_w_matrix)
 
-        box_h_matrix = np.reshape(boxes[:, 1].repeat(k), (n, k))
-        cluster_h_matrix = np.reshape(np.tile(clusters[:, 1], (1, n)), (n, k))
-        min_h_matrix = np.minimum(cluster_h_matrix, box_h_matrix)
-        inter_area = np.multiply(min_w_matrix, min_h_matrix)
+class YOLO_Kmeans:
 
-        result = inter_area / (box_area + cluster_area - inter_area)
-        return result
+    def __init__(self, cluster_number, filename):
+        self.cluster_number = cluster_number
+        self.filename = filename
 
-    def avg_iou(self, boxes, clusters):
-        accuracy = np.mean([np.max(self.iou(boxes, clusters), axis=1)])
-        return accuracy
-
-    def kmeans(self, boxes, k, dist=np.median):
-        box_number = boxes.shape[0]
-        distances = np.empty((box_number, k))
-        last_nearest = np.zeros((box_number,))
-        np.random.seed()
-        clusters = boxes[np.random.choice(
-            box_number, k, replace=False)]  # init k clusters
-        max_try = 20000
-        while True and max_try > 0:
-
-            distances = 1 - self.iou(boxes, clusters)
-            max_try -= 1
-
-            current_nearest = np.argmin(distances, axis=1)
-            if (last_nearest == current_nearest).all():
+    def iou(self, boxes, clusters):  # n boxes -> k clusters, (n, k)
+        inter_area = np.minimum(boxes[:, np.newaxis, 0], clusters[np.newaxis, :, 0]) * \
+                     np.minimum(boxes[:, np.newaxis, 1], clusters[np.newaxis, :, 1])
+        box_area = boxes[:, 0] * boxes[:, 1]
+        cluster_area = clusters[:, 0] * clusters[:, 1]
+        return inter_area / (box_area[:, np.newaxis] + cluster_area[np.newaxis, :] - inter_area)
+
+    def avg_iou(self, boxes, clusters, chunk=1 << 18):
+        best = [np.max(self.iou(boxes[i: i + chunk], clusters), axis=1) for i in range(0, len(boxes), chunk)]
+        return np.concatenate(best).mean()
+
+    def nearest(self, boxes, clusters, chunk=1 << 18):
+        return np.concatenate([np.argmax(self.iou(boxes[i: i + chunk], clusters), axis=1)
+                               for i in range(0, len(boxes), chunk)])
+
+    def seed(self, boxes, k, rng, sample=100000):
+        '''
+            k-means++ on at most sample boxes: next center drawn with probability ~ (1 - iou)^2
+        '''
+        if len(boxes) > sample:
+            boxes = boxes[rng.choice(len(boxes), sample, replace=False)]
+        clusters = [boxes[rng.randint(len(boxes))]]
+        distance = 1 - self.iou(boxes, np.array(clusters))[:, 0]
+        for _ in range(1, k):
+            weight = distance ** 2
+            total = weight.sum()
+            pick = rng.choice(len(boxes), p=weight / total) if total > 0 else rng.randint(len(boxes))
+            clusters.append(boxes[pick])
+            distance = np.minimum(distance, 1 - self.iou(boxes, boxes[pick][np.newaxis])[:, 0])
+        return np.array(clusters, dtype=np.float64)
+
+    def kmeans(self, boxes, k, dist=np.median, seed=None, batch_size=0, max_iter=300, init=None):
+        '''
+            batch_size 0 or >= len(boxes): full lloyd steps with dist, until no box changes cluster.
+            otherwise mini-batch k-means (per cluster running mean over sampled boxes) until the
+            centers settle, then lloyd steps on 4 * batch_size sampled boxes.
+        '''
+        boxes = np.asarray(boxes, dtype=np.float64)
+        rng = np.random.RandomState(seed)
+        clusters = self.seed(boxes, k, rng) if init is None else np.array(init, dtype=np.float64)
+
+        if batch_size and batch_size < len(boxes):
+            counts = np.zeros(k)
+            for _ in range(max_iter):
+                batch = boxes[rng.randint(len(boxes), size=batch_size)]
+                nearest = self.nearest(batch, clusters)
+                num = np.bincount(nearest, minlength=k)
+                sums = np.stack([np.bincount(nearest, batch[:, i], minlength=k) for i in range(2)], axis=-1)
+                counts += num
+                step = (sums - num[:, np.newaxis] * clusters) / np.maximum(counts, 1)[:, np.newaxis]
+                clusters += step
+                if (np.abs(step) / clusters).max() < 1e-3:
+                    break
+            sample = boxes[rng.choice(len(boxes), min(len(boxes), 4 * batch_size), replace=False)]
+            return self.kmeans(sample, k, dist, max_iter=max_iter, init=clusters)
+
+        last_nearest = None
+        for _ in range(max_iter):
+            current_nearest = self.nearest(boxes, clusters)
+            if last_nearest is not None and (last_nearest == current_nearest).all():
                 break  # clusters won't change
-            print(max_try, boxes.shape)
             for cluster in range(k):
-                clusters[cluster] = dist(  # update clusters
-                    boxes[current_nearest == cluster], axis=0)
-
+                members = boxes[current_nearest == cluster]
+                if len(members):
+                    clusters[cluster] = dist(members, axis=0)  # update clusters
+                else:
+                    # empty cluster takes the box the others cover worst
+                    clusters[cluster] = boxes[np.argmin(np.max(self.iou(boxes, clusters), axis=1))]
             last_nearest = current_nearest
-
         return clusters
 
-    def result2txt(self, data):
-        f = open("yolo_anchors.txt", 'w')
-        row = np.shape(data)[0]
-        for i in range(row):
-            if i == 0:
-                x_y = "%d,%d" % (data[i][0], data[i][1])
-            else:
-                x_y = ", %d,%d" % (data[i][0], data[i][1])
-            f.write(x_y)
-        f.close()
+    def fit(self, boxes, restarts=8, workers=4, batch_size=0, max_iter=300, seed=0):
+        '''
+            restarts runs of kmeans with seeds seed .. seed + restarts - 1, in workers processes
+        '''
+        from multiprocessing import Pool
+
+        tasks = [(self.cluster_number, seed + i, batch_size, max_iter) for i in range(restarts)]
+        if workers > 1 and restarts > 1:
+            with Pool(min(workers, restarts), initializer=kmeans_worker_init, initargs=(boxes,)) as pool:
+                runs = pool.map(kmeans_worker, tasks)
+        else:
+            kmeans_worker_init(boxes)
+            runs = [kmeans_worker(task) for task in tasks]
+        for i, (_, accuracy) in enumerate(runs):
+            print("restart %d avg iou %.4f" % (i, accuracy))
+        clusters, accuracy = max(runs, key=lambda run: run[1])
+        return clusters[np.argsort(clusters[:, 0] * clusters[:, 1])], accuracy
+
+    def result2txt(self, anchors, path="anchors.txt"):
+        '''
+            anchors (strides, anchors_per_scale, 2) in grid units, one line of comma separated floats
+        '''
+        with open(path, "w") as f:
+            f.write(", ".join("%g" % v for v in np.reshape(anchors, (-1,))))
+        print("!!!!!! %s" % path)
 
     def txt2boxes(self):
-        f = open(self.filename, 'r')
-        dataSet = []
-        for line in f:
-            infos = line.strip().split()
-            boxes = list(map(lambda x: [int(b) for b in x.split(",")[:4]], infos[1:]))
-            dataSet += boxes
-        locs = np.array(dataSet)
+        locs = AnnotationIndex.from_files(self.filename).boxes[:, :4]
         print(locs.shape)
         result = np.concatenate([locs[:, 2:3] - locs[:, 0:1], locs[:, 3:4] - locs[:, 1:2]], axis=-1)
-        f.close()
         return result
 
 
 
-    def txt2clusters(self):
-        all_boxes = self.txt2boxes()
-        result = self.kmeans(all_boxes, k=self.cluster_number)
-        result = result[np.lexsort(result.T[0, None])]
-        self.result2txt(result)
-        anchor_scale = list(map(str, (np.array(result) / np.array([32, 32, 32,32,32,32]).reshape((-1, 2))/ 2).reshape((-1,)).tolist()))
-        print(",".join(anchor_scale))
-        print("K anchors:\n {}".format(result))
-        print("Accuracy: {:.2f}%".format(
-            self.avg_iou(all_boxes, result) * 100))
-        print(",".join([str(x) for x in result.reshape((-1,))]))
+    def txt2clusters(self, strides=(16, 32), per_stride=False, scale=1., restarts=8, workers=4, batch_size=0,
+                     path="anchors.txt"):
+        '''
+            per_stride: cluster_number * len(strides) clusters, smallest ones go to the finest stride;
+            otherwise the same cluster_number anchors (in pixels) are shared by every stride.
+            scale maps annotation pixels to network input pixels, e.g. 224 / 640.
+        '''
+        strides = [int(stride) for stride in strides]
+        all_boxes = self.txt2boxes() * scale
+        anchors_per_scale = self.cluster_number
+        if per_stride:
+            self.cluster_number = anchors_per_scale * len(strides)
+        batch_size = batch_size if batch_size and len(all_boxes) > batch_size else 0
+        result, accuracy = self.fit(all_boxes, restarts, workers, batch_size)
+        self.cluster_number = anchors_per_scale
+
+        groups = np.split(result, len(strides)) if per_stride else [result] * len(strides)
+        anchors = np.array([group / stride for group, stride in zip(groups, strides)])
+        self.result2txt(anchors, path)
+
+        print("K anchors (pixels):\n {}".format(result))
+        print("Accuracy: {:.2f}%".format(accuracy * 100))
+        if per_stride:
+            nearest = self.nearest(all_boxes, result) // anchors_per_scale
+            for i, (stride, group) in enumerate(zip(strides, groups)):
+                members = all_boxes[nearest == i]
+                print("stride %d boxes %d avg iou %.2f%%" % (stride, len(members),
+                      self.avg_iou(members, group) * 100 if len(members) else 0))
+        print(",".join(["%g" % x for x in anchors.reshape((-1,))]))
+        return anchors
 
     def txt2boxes_remove_size(self, size=608., workers=10):
         from multiprocessing import Manager, Lock
@@ -107,12 +175,9 @@ class YOLO_Kmeans:
         manager = Manager()
         queue = manager.list()
         result = manager.list()
-        with open(self.filename, 'r') as f:
-            for line in f.readlines():
-                infos = line.strip().split()
-                image_path = infos[0]
-                boxes = list(map(lambda x: [float(b) for b in x.split(",")[:5]], infos[1:]))
-                queue.append((image_path, boxes))
+        index = AnnotationIndex.from_files(self.filename)
+        for idx in range(len(index)):
+            queue.append((index.path(idx), index.sample_boxes(idx).astype(np.float64).tolist()))
         print(len(queue))
 
         #while(queue):
@@ -138,19 +203,22 @@ class YOLO_Kmeans:
         return np.concatenate(bboxes, axis=0)[:, :2]
 
 
-    def txt2clusters2(self, sizes=[160.0, 320.0]):
+    def txt2clusters2(self, sizes=[160.0, 320.0], strides=(16, 32), restarts=8, workers=4, path="anchors.txt"):
+        '''
+            boxes rescaled to every input size in sizes (longest image side -> size, at most 150
+            per class and size), the same cluster_number anchors are shared by every stride
+        '''
         org_bboxes = self.txt2boxes()
         all_bboxes = np.concatenate([self.txt2boxes_remove_size(size) for size in sizes], axis=0)
         print("ddd",  all_bboxes.shape)
-        result = self.kmeans(all_bboxes, k=self.cluster_number)
-        result = result[np.lexsort(result.T[0, None])]
-        self.result2txt(result)
-        anchor_scale = list(map(str, (np.array(result) / np.array([16] * self.cluster_number + [32] * self.cluster_number).reshape((-1, 2))).reshape((-1,)).tolist()))
-        print(",".join(anchor_scale))
+        result, accuracy = self.fit(all_bboxes, restarts, workers)
+        anchors = np.array([result / int(stride) for stride in strides])
+        self.result2txt(anchors, path)
+        print(",".join(["%g" % x for x in anchors.reshape((-1,))]))
         print("K anchors:\n {}".format(result))
-        print("Accuracy: {:.2f}%".format(
-            self.avg_iou(org_bboxes, result) * 100))
-        print(",".join([str(x) for x in result.reshape((-1,))]))
+        print("Accuracy: {:.2f}%".format(accuracy * 100))
+        print("Accuracy on annotation sizes: {:.2f}%".format(self.avg_iou(org_bboxes, result) * 100))
+        return anchors
 
 def proc_lines(queue, result, size):
     while(queue):
@@ -168,8 +236,10 @@ def proc_lines(queue, result, size):
 
 
 if __name__ == "__main__":
-    cluster_number = 3
-    filename = "./data/train.ano"  # "./data/dataset/cancer_train.ano"
-    kmeans = YOLO_Kmeans(cluster_number, filename)
+    from utils.utils import build_params
+
+    params = build_params()
+    kmeans = YOLO_Kmeans(params.anchors.shape[1], params.train_ano)
     #kmeans.txt2clusters2([128, 160, 192, 224, 256, 288, 320, 352, 384, 416])
-    kmeans.txt2clusters()
+    kmeans.txt2clusters(params.strides, params.kmeans_per_stride, params.kmeans_scale, params.kmeans_restarts,
+                        params.kmeans_workers, params.kmeans_batch, params.kmeans_out)
@@ -0,0 +1,49 @@
+import time
+import threading
+import cv2
+import numpy as np
+from utils.utils import build_params
+from utils.annotation import AnnotationIndex
+from utils.server import DetectionClient
+
+'''
+    load generator for demo.py --mode serve:
+        >> python demo.py --mode serve --pretrain_model=./pretrained/cp-30-3.614092 --batch_window 5
+        >> python loadgen.py --clients 8 --requests 200
+    every client sends eval_ano images back to back over its own connection.
+'''
+
+
+def run_client(params, images, latencies):
+    client = DetectionClient(params.serve_address)
+    for i in range(params.requests):
+        start = time.time()
+        client.detect(images[i % len(images)], jpeg=not params.raw_frames)
+        latencies.append(time.time() - start)
+    client.close()
+
+
+def loadgen(params):
+    paths = AnnotationIndex.from_files(params.eval_ano).paths[:32]
+    images = [img for img in (cv2.imread(str(path)) for path in paths) if img is not None]
+    latencies = [[] for _ in range(params.clients)]
+    workers = [threading.Thread(target=run_client, args=(params, images, latencies[i])) for i in range(params.clients)]
+
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    cost = time.time() - start
+
+    latencies = np.concatenate(latencies) * 1000
+    print("clients: %d requests: %d qps: %.1f p50: %.1fms p90: %.1fms p99: %.1fms" % (params.clients, len(latencies),
+        len(latencies) / cost, np.percentile(latencies, 50), np.percentile(latencies, 90), np.percentile(latencies, 99)))
+
+    client = DetectionClient(params.serve_address)
+    print("server:", client.stats())
+    client.close()
+
+
+if __name__ == "__main__":
+    loadgen(build_params())
@@ -0,0 +1,14 @@
+import os
+from utils.params import build_args as build_params
+from utils.shards import pack_annotations
+
+'''
+    one-off: decode the train/test annotations into memory-mapped shards
+    >> python pack.py --shard_dir ./data/shards [--shard_downscale]
+    then train with the same --shard_dir
+'''
+if __name__ == "__main__":
+    params = build_params()
+    max_size = max(params.train_input_sizes) if params.shard_downscale else None
+    pack_annotations(params.train_ano.split(","), os.path.join(params.shard_dir, "train"), max_size)
+    pack_annotations(params.test_ano.split(","), os.path.join(params.shard_dir, "test"), max_size)
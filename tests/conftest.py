@@ -0,0 +1,48 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def write_samples(root, num, rng):
+    '''
+        num small jpegs with one to three boxes each, annotation lines in the .ano format
+    '''
+    lines = []
+    for i in range(num):
+        h, w = rng.randint(80, 160), rng.randint(80, 160)
+        image = rng.randint(0, 256, (h, w, 3)).astype(np.uint8)
+        path = os.path.join(root, "%d.jpg" % i)
+        cv2.imwrite(path, image)
+        boxes = []
+        for _ in range(rng.randint(1, 4)):
+            x1, y1 = rng.randint(0, w // 2), rng.randint(0, h // 2)
+            boxes.append("%d,%d,%d,%d,%d" % (x1, y1, rng.randint(x1 + 8, w), rng.randint(y1 + 8, h), rng.randint(0, 8)))
+        lines.append(" ".join([path] + boxes))
+    return lines
+
+
+@pytest.fixture
+def make_dataset(tmp_path, monkeypatch):
+    '''
+        make_dataset(num_samples, *args) -> Dataset("train") built by its constructor from command line args,
+        over a tiny annotation file of random jpegs, without loader workers.
+        default anchors (data/anchors), 8 categories, strides 16 and 32
+    '''
+    from utils.utils import build_params
+    from utils.dataset import Dataset
+
+    def make(num_samples=8, *args):
+        ano = str(tmp_path / "train.ano")
+        with open(ano, "w") as fd:
+            fd.write("\n".join(write_samples(str(tmp_path), num_samples, np.random.RandomState(0))) + "\n")
+        # anchors and categories defaults are relative to the repo root
+        monkeypatch.chdir(ROOT)
+        monkeypatch.setattr(sys, "argv", ["pytest", "--train_ano", ano, "--test_ano", ano] + list(args))
+        return Dataset("train", build_params(), pworker=0)
+    return make
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from utils.annotation import AnnotationIndex
+
+
+LINES = [
+    "a/1.jpg 1,2,30,40,0 5,6,70,80,3",
+    "",
+    "a/2.jpg",
+    "b/3.jpg 10,20,30,40,7",
+    "a/1.jpg 0,0,1,1,1 2,2,3,3,2 4,4,5,5,5",
+    "b/4.jpg 9,9,99,99,4",
+]
+
+
+def write_ano(tmp_path):
+    path = tmp_path / "train.ano"
+    path.write_text("\n".join(LINES) + "\n")
+    return str(path)
+
+
+def test_chunked_parse_matches_single_chunk(tmp_path):
+    path = write_ano(tmp_path)
+    whole = AnnotationIndex.parse(path)
+    for chunk_lines in [1, 2, 3]:
+        index = AnnotationIndex.parse(path, chunk_lines=chunk_lines)
+        assert np.array_equal(index.paths, whole.paths)
+        assert np.array_equal(index.path_ids, whole.path_ids)
+        assert np.array_equal(index.box_offsets, whole.box_offsets)
+        assert np.array_equal(index.boxes, whole.boxes)
+        assert np.array_equal(index.scores, whole.scores)
+        assert index.boxes.dtype == np.int32
+
+
+def test_parse_layout(tmp_path):
+    index = AnnotationIndex.parse(write_ano(tmp_path), chunk_lines=2)
+    assert len(index) == 5
+    assert index.path(3) == "a/1.jpg"
+    assert index.sample_boxes(1).shape == (0, 5)
+    assert index.sample_boxes(3)[:, 4].tolist() == [1, 2, 5]
+    assert index.box_counts().tolist() == [2, 0, 1, 3, 1]
+
+
+def test_scored_rows(tmp_path):
+    path = tmp_path / "detections.ano"
+    path.write_text("a/1.jpg 1,2,30,40,0.75,3 5,6,70,80,1\nb/2.jpg 9,9,99,99,0.5,7\n")
+    index = AnnotationIndex.parse(str(path), chunk_lines=1)
+    assert index.boxes.tolist() == [[1, 2, 30, 40, 3], [5, 6, 70, 80, 1], [9, 9, 99, 99, 7]]
+    assert index.scores.tolist() == [0.75, 1, 0.5]
+
+
+@pytest.mark.parametrize("line", ["a/1.jpg 1,2,3,4", "a/1.jpg 1,2,3,4,5,6,7", "a/1.jpg 1,2,3,4,5,6 1,2,3,4"])
+def test_bad_box_raises(tmp_path, line):
+    path = tmp_path / "bad.ano"
+    path.write_text(line + "\n")
+    with pytest.raises(ValueError):
+        AnnotationIndex.parse(str(path))
+
+
+def test_cache_and_concat_keep_scores(tmp_path):
+    path = tmp_path / "detections.ano"
+    path.write_text("a/1.jpg 1,2,30,40,0.75,3\n")
+    first = AnnotationIndex.from_files(str(path))
+    cached = AnnotationIndex.load(str(path))
+    assert (tmp_path / "detections.ano.idx.npz").exists()
+    assert cached.scores.tolist() == first.scores.tolist() == [0.75]
+    both = AnnotationIndex.from_files(",".join([write_ano(tmp_path), str(path)]))
+    assert len(both.scores) == len(both.boxes) and both.scores[-1] == 0.75
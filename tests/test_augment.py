@@ -0,0 +1,32 @@
+import random
+
+import numpy as np
+
+
+def check_sample(image, bboxes, input_size):
+    assert image.shape == (input_size, input_size, 3)
+    bboxes = np.reshape(bboxes, (-1, 5))
+    assert np.all(bboxes[:, :2] <= bboxes[:, 2:4])
+    assert np.all(bboxes[:, :4] >= 0) and np.all(bboxes[:, :4] <= input_size)
+
+
+def test_chained_and_fused(make_dataset):
+    dataset = make_dataset()
+    for fused in [False, True]:
+        dataset.fused_aug = fused
+        random.seed(0)
+        np.random.seed(0)
+        # rotate fires on 80% of the chained samples, every sample has boxes
+        for idx in dataset.annotations:
+            check_sample(*dataset.parse_annotation(idx, 160), 160)
+
+
+def test_rotate_keeps_boxes_inside(make_dataset):
+    dataset = make_dataset()
+    image, bboxes = dataset.load_sample(0)
+    random.seed(1)
+    for _ in range(10):
+        rotated, rboxes = dataset.rotate(np.copy(image), np.copy(bboxes))
+        assert rotated.shape == image.shape and rboxes.dtype == bboxes.dtype
+        assert np.all(rboxes[:, :2] <= rboxes[:, 2:4])
+        assert np.all(rboxes[:, [2]] <= image.shape[1]) and np.all(rboxes[:, [3]] <= image.shape[0])
@@ -0,0 +1,31 @@
+import numpy as np
+from gmm import GMM, GMMLoop
+
+H, W = 40, 60
+
+
+def sequence(num=24):
+    # noisy static background with a block sliding across it
+    rng = np.random.RandomState(0)
+    background = rng.randint(0, 256, (H, W, 3)).astype(np.float64)
+    frames = []
+    for t in range(num):
+        frame = np.clip(background + rng.normal(0, 3, background.shape), 0, 255).astype(np.uint8)
+        x = t * 3 % (W - 16)
+        frame[12:28, x:x + 16] = (200, 30, 90)
+        frames.append(frame)
+    return frames
+
+
+def test_vector_matches_loop():
+    loop, vector64, vector32 = GMMLoop(H, W, 5), GMM(H, W, 5, dtype=np.float64), GMM(H, W, 5)
+    for t, frame in enumerate(sequence()):
+        mask = loop.fit(frame)
+        assert np.array_equal(vector64.fit(frame), mask), t
+        # float32 rounding has not flipped a pixel on this sequence, see MASK_TOLERANCE in benchmark.py
+        assert np.array_equal(vector32.fit(frame), mask), t
+        if t > 2:
+            # True is background: the rows above the block stay background, the block does not
+            assert mask[:8].all() and not mask[12:28].all()
+    for name in ["omega", "means", "variance"]:
+        assert np.array_equal(getattr(vector64, name), getattr(loop, name)), name
@@ -0,0 +1,47 @@
+import numpy as np
+
+
+def random_boxes(rng, input_size, num):
+    wh = rng.uniform(4, input_size * 0.9, (num, 2))
+    x1y1 = rng.uniform(0, 1, (num, 2)) * (input_size - 1 - wh)
+    cid = rng.randint(0, 8, (num, 1))
+    return np.concatenate([x1y1, x1y1 + wh, cid], axis=-1).astype(np.int32)
+
+
+def assert_same_labels(dataset, batch_bboxes, input_size):
+    output_sizes = input_size // dataset.strides
+    loop = list(zip(*[dataset.preprocess_true_boxes(bboxes, output_sizes) for bboxes in batch_bboxes]))
+    batch = dataset.preprocess_true_boxes_batch(batch_bboxes, output_sizes)
+    for label, label_batch in zip(loop, batch):
+        assert np.array_equal(np.stack(label), label_batch)
+
+
+def test_random_batches(make_dataset):
+    rng = np.random.RandomState(0)
+    dataset = make_dataset()
+    for step in range(50):
+        input_size = [128, 224, 416][step % 3]
+        batch_bboxes = [random_boxes(rng, input_size, rng.randint(0, 6)) for _ in range(4)]
+        assert_same_labels(dataset, batch_bboxes, input_size)
+
+
+def test_overlapping_boxes_in_one_cell(make_dataset):
+    dataset = make_dataset()
+    # same center cell and similar shape, the later box overwrites the earlier one
+    bboxes = np.array([[40, 40, 80, 90, 1], [42, 41, 81, 88, 3], [41, 43, 79, 91, 5]], dtype=np.int32)
+    assert_same_labels(dataset, [bboxes, bboxes[::-1], bboxes[:1]], 224)
+
+
+def test_best_anchor_fallback(make_dataset):
+    dataset = make_dataset()
+    # tiny and very elongated boxes match no anchor above 0.3 iou
+    bboxes = np.array([[10, 10, 13, 12, 0], [100, 100, 102, 103, 2], [5, 60, 215, 66, 4], [70, 2, 74, 220, 7]],
+                      dtype=np.int32)
+    output_sizes = 224 // dataset.strides
+    scaled = np.array([[(b[0] + b[2]) / 2, (b[1] + b[3]) / 2, b[2] - b[0], b[3] - b[1]] for b in bboxes])
+    for box in scaled:
+        for i in range(2):
+            anchors = np.concatenate([np.tile(np.floor(box[:2] / dataset.strides[i]) + 0.5, (3, 1)), dataset.anchors[i]], axis=-1)
+            assert not np.any(dataset.bbox_iou(box[np.newaxis] / dataset.strides[i], anchors) > 0.3)
+    assert_same_labels(dataset, [bboxes, bboxes[:2], np.zeros((0, 5), dtype=np.int32)], 224)
+    assert np.stack(dataset.preprocess_true_boxes_batch([bboxes], output_sizes)[0])[..., 4].sum() > 0
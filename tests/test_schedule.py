@@ -0,0 +1,54 @@
+import threading
+
+import numpy as np
+
+# batch_size 3 at a budget of 224 px: 128 -> 9, 224 -> 3, 320 -> 1
+SCHEDULE_ARGS = ["--train_input_sizes", "128", "224", "320", "--batch_size", "3", "--pixel_budget_size", "224"]
+
+
+def make_scheduled(make_dataset, num_samples=60):
+    dataset = make_dataset(num_samples, *SCHEDULE_ARGS)
+    # blank images tagged with their sample id, no decode or augmentation
+    dataset.parse_annotation = lambda idx, size: (np.full((size, size, 3), idx, np.float32), np.zeros((0, 5), np.int32))
+    return dataset
+
+
+def test_schedule_balances_sizes(make_dataset):
+    dataset = make_scheduled(make_dataset)
+    assert dataset.size_batchs == {128: 9, 224: 3, 320: 1}
+    sizes, counts = np.unique(dataset.size_schedule, return_counts=True)
+    assert sizes.tolist() == [128, 224, 320]
+    assert counts.max() - counts.min() <= 1
+    assert len(dataset.size_schedule) == dataset.num_batchs
+
+
+def test_produce_follows_schedule(make_dataset):
+    dataset = make_scheduled(make_dataset)
+    schedule = dataset.size_schedule.copy()
+    seen = []
+    for step in range(dataset.num_batchs):
+        image, labels = dataset.produce()
+        assert image.shape[:2] == (dataset.size_batchs[schedule[step]], schedule[step])
+        assert [label.shape[1] for label in labels] == (schedule[step] // dataset.strides).tolist()
+        seen += image[:, 0, 0, 0].astype(int).tolist()
+    assert dataset.batch_count == dataset.num_batchs
+    assert dataset.read_index == sum(dataset.size_batchs[size] for size in schedule)
+    # one epoch of steps covers every sample
+    assert set(seen) == set(dataset.annotations.tolist())
+
+
+def test_threads_share_schedule(make_dataset):
+    dataset = make_scheduled(make_dataset)
+    schedule = dataset.size_schedule.copy()
+    produced = []
+
+    def work():
+        for _ in range(dataset.num_batchs // 2):
+            produced.append(dataset.produce()[0].shape[1])
+
+    workers = [threading.Thread(target=work) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert sorted(produced) == sorted(schedule[:len(produced)])
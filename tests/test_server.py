@@ -0,0 +1,57 @@
+import threading
+
+import numpy as np
+import pytest
+from utils.server import DetectionClient, HEADER, KIND_JPEG, KIND_RAW, build_server
+
+FAIL_HEIGHT = 13
+
+
+def stub_run_batch(imgs, org_shapes, metas):
+    # one box per image holding its original shape and letterbox scale, a FAIL_HEIGHT frame fails the whole batch
+    if any(h == FAIL_HEIGHT for h, _ in org_shapes):
+        raise RuntimeError("model failed")
+    return [[[0, 0, w, h, scale, 0]] for (h, w), (scale, _, _) in zip(org_shapes, metas)]
+
+
+@pytest.fixture
+def client(tmp_path):
+    address = str(tmp_path / "detect.sock")
+    server = build_server(address, stub_run_batch, 64, window=0.001)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = DetectionClient(address)
+    yield client
+    client.close()
+    server.shutdown()
+    server.server_close()
+
+
+def frame(h=48, w=128):
+    return np.full((h, w, 3), 128, dtype=np.uint8)
+
+
+def test_detect(client):
+    for jpeg in [True, False]:
+        assert client.detect(frame(), jpeg=jpeg).tolist() == [[0, 0, 128, 48, 0.5, 0]]
+
+
+def test_bad_jpeg_keeps_connection(client):
+    client.sock.sendall(HEADER.pack(KIND_JPEG, 48, 80, 4) + b"junk")
+    with pytest.raises(RuntimeError, match="decode"):
+        client.read_bboxes()
+    assert client.detect(frame()).shape == (1, 6)
+
+
+def test_bad_raw_size_keeps_connection(client):
+    payload = frame().tobytes()[:-1]
+    client.sock.sendall(HEADER.pack(KIND_RAW, 48, 128, len(payload)) + payload)
+    with pytest.raises(RuntimeError, match="48x128x3"):
+        client.read_bboxes()
+    assert client.detect(frame(), jpeg=False).shape == (1, 6)
+
+
+def test_run_batch_error_keeps_connection(client):
+    with pytest.raises(RuntimeError, match="model failed"):
+        client.detect(frame(h=FAIL_HEIGHT), jpeg=False)
+    assert client.detect(frame()).shape == (1, 6)
+    assert client.stats()["requests"] == 2
@@ -0,0 +1,45 @@
+import numpy as np
+from utils.utils import letterbox_window, postprocess_boxes
+from utils.tracking import RoiDetector
+
+
+def pred(cx, cy, w, h, cid=2, class_num=8):
+    row = np.zeros(5 + class_num, dtype=np.float32)
+    row[:5] = cx, cy, w, h, 0.9
+    row[5 + cid] = 1
+    return row
+
+
+def test_window_meta_maps_to_frame():
+    frame = np.full((200, 300, 3), 90, dtype=np.uint8)
+    window = (100, 50, 180, 130)
+    img, meta = letterbox_window(frame, window, [160, 160])
+    assert img.shape == (160, 160, 3)
+    assert meta == (2., -200., -100.)
+    # inside the crop, and one reaching past the crop edge that only the frame clips
+    bboxes = postprocess_boxes(np.stack([pred(40, 60, 20, 40), pred(150, 80, 40, 20)]), frame.shape[:2], 160, 0.3, meta)
+    assert np.allclose(bboxes[0][:4], [115, 70, 125, 90])
+    assert np.allclose(bboxes[1][:4], [165, 85, 185, 95])
+
+
+def test_window_meta_clips_to_frame():
+    frame = np.full((200, 300, 3), 90, dtype=np.uint8)
+    img, meta = letterbox_window(frame, (220, 120, 300, 200), [160, 160])
+    bboxes = postprocess_boxes(np.stack([pred(150, 150, 40, 40)]), frame.shape[:2], 160, 0.3, meta)
+    assert np.allclose(bboxes[0][:4], [285, 185, 299, 199])
+
+
+def test_roi_detector_passes_window():
+    calls = []
+
+    def detect(org_img, input_size, window=None):
+        calls.append((input_size, window))
+        return [np.array([100, 60, 140, 100, 0.9, 1], dtype=np.float32)]
+
+    roi = RoiDetector(detect, 224, roi_size=96, full_interval=3, expand=2.)
+    frame = np.zeros((240, 320, 3), dtype=np.uint8)
+    for _ in range(5):
+        bboxes = roi.step(frame)
+        assert np.allclose(bboxes[0], [100, 60, 140, 100, 0.9, 1])
+    assert calls[0] == (224, None) and calls[4] == (224, None)
+    assert calls[1:4] == [(96, (72, 32, 168, 128))] * 3
@@ -1,11 +1,13 @@
 import os
 import cv2
+import time
 import numpy as np
 import tensorflow as tf
 from utils.utils import image_preporcess, postprocess_boxes, nms, draw_bbox, build_params, config_gpu
 from utils.dataset import Dataset
+from utils.profiling import configure as configure_profiling
 from tensorflow.keras.optimizers import Adam
-from tensorflow.keras.callbacks import ModelCheckpoint, TensorBoard, EarlyStopping, LearningRateScheduler, ReduceLROnPlateau, LambdaCallback
+from tensorflow.keras.callbacks import ModelCheckpoint, TensorBoard, EarlyStopping, LearningRateScheduler, ReduceLROnPlateau, LambdaCallback, Callback
 
 tf.compat.v1.disable_eager_execution()
 from tensorflow.keras import Input
@@ -36,6 +38,27 @@ def block_another(input, params):
     block1 = block_conv(input, [3, 3, -1, 16], name="block1", bn=params.bn, se=params.se)
     return tf.concat([bgd, block1], axis=-1) 
 
+def edge_channel(input, low=100., high=200.):
+    '''
+        in-graph stand-in for the --canny channel, input is the rgb (0-255) network input:
+        sobel |gx| + |gy| per channel (cv2.Canny L1 gradient), max over channels, canny thresholds
+        as a soft ramp instead of hysteresis, normalized by the rgb mean / std like image_preporcess.
+        fixed kernels, no weights, so canny checkpoints load unchanged.
+    '''
+    sobel_x = np.array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]], dtype=np.float32)
+    kernel = np.zeros([3, 3, 3, 6], dtype=np.float32)   # out 0-2: gx of r, g, b ; out 3-5: gy
+    for c in range(3):
+        kernel[:, :, c, c], kernel[:, :, c, 3 + c] = sobel_x, sobel_x.T
+
+    with tf.name_scope("edge"):
+        # zero "same" padding of (input - 128) == the 128 gray border letterbox pads with
+        grad = tf.abs(tf.nn.conv2d(input - 128., kernel, strides=[1, 1, 1, 1], padding="SAME"))
+        magnitude = tf.reduce_max(grad[..., :3] + grad[..., 3:], axis=-1, keepdims=True)
+        edge = tf.clip_by_value((magnitude - low) / (high - low), 0., 1.) * 255.
+        mean, var = tf.nn.moments(input, axes=[1, 2, 3], keepdims=True)
+        edge = (edge - mean) / tf.sqrt(var + 1e-6)
+    return tf.concat([input, edge], axis=-1)
+
 def block_conv(input, kernel_shape, name, padding="same", strides=(2, 2), activation=None, pooling="max", bn=False, se=False):
     conv = tf.keras.layers.Conv2D(kernel_shape[-1],
             tuple(kernel_shape[:2]), padding="same",
@@ -170,7 +193,7 @@ def region_decode(conv1, conv2, class_num, stride, anchor, name):
     pred = decode(raw_pred, anchor, stride=stride, class_num=class_num, name=name)
     return raw_pred, pred
 
-def loss_layer(conv, anchors, stride, class_num, iou_loss_thresh=0.5, max_bbox_per_scale=150, distribution=None):
+def loss_layer(conv, anchors, stride, class_num, iou_loss_thresh=0.5, max_bbox_per_scale=150, distribution=None, compact_gt=True):
     conv_shape = tf.shape(conv)
     batch_size, output_size = conv_shape[0], conv_shape[1]
     input_size = stride * output_size
@@ -199,6 +222,11 @@ def loss_layer(conv, anchors, stride, class_num, iou_loss_thresh=0.5, max_bbox_p
         label_prob    = label[:, :, :, :, 5:]
 
         bboxes = tf.reshape(label[..., 0:4], (batch_size, -1, 4))  # change to n:4
+        if compact_gt:
+            # only responding cells hold a gt box, keep at most max_bbox_per_scale of them
+            respond_flat = tf.reshape(respond_bbox, (batch_size, -1))
+            _, respond_ind = tf.math.top_k(respond_flat, k=tf.minimum(max_bbox_per_scale, tf.shape(respond_flat)[1]))
+            bboxes = tf.gather(bboxes, respond_ind, batch_dims=1)
 
 
         giou = tf.expand_dims(bbox_giou(pred_xywh, label_xywh), axis=-1)
@@ -238,7 +266,8 @@ def loss_layer(conv, anchors, stride, class_num, iou_loss_thresh=0.5, max_bbox_p
     return gen_loss 
 
 def lite_backbone_net(input, params):
-    block1 = block_conv(input, [3, 3, -1, 16], name="block1", bn=params.bn, se=params.se)
+    feature = edge_channel(input) if params.edge_channel else input
+    block1 = block_conv(feature, [3, 3, -1, 16], name="block1", bn=params.bn, se=params.se)
     block2 = block_conv(block1, [3, 3, 16, 32], activation=LReLU(), name="block2", bn=params.bn, se=params.se)
     block3 = block_conv(block2, [3, 3, 32, 64], activation=LReLU(), name="block3", bn=params.bn, se=params.se)
     block4 = block_conv(block3, [3, 3, 64, 128], activation=LReLU(), name="block4", bn=params.bn, se=params.se)
@@ -250,7 +279,8 @@ def lite_backbone_net(input, params):
     return backbone, [block4, block5, block7]
 
 def lite_backbone_net2(input, params):
-    block1 = block_another(input, params)
+    feature = edge_channel(input) if params.edge_channel else input
+    block1 = block_another(feature, params)
     block2 = block_conv(block1, [3, 3, 16, 32], activation=LReLU(), name="block2", bn=params.bn, se=params.se)
     block3 = block_conv(block2, [3, 3, 32, 64], activation=LReLU(), name="block3", bn=params.bn, se=params.se)
     block4 = block_conv(block3, [3, 3, 64, 128], activation=LReLU(), name="block4", bn=params.bn, se=params.se)
@@ -262,13 +292,41 @@ def lite_backbone_net2(input, params):
     return backbone, [block4, block5, block7]
 
 
-def get_callbacks(params):
+class ScaleThroughput(Callback):
+    '''
+        steps/sec and images/sec per input size. keras consumes the generator
+        in order, so the size of step i is the i-th size handed out by the dataset.
+    '''
+    def __init__(self, dataset):
+        super(ScaleThroughput, self).__init__()
+        self.dataset = dataset
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.stats = {}
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.size = self.dataset.handed_sizes.popleft() if self.dataset.handed_sizes else 0
+        self.start = time.time()
+
+    def on_train_batch_end(self, batch, logs=None):
+        steps, images, cost = self.stats.get(self.size, (0, 0, 0.0))
+        self.stats[self.size] = (steps + 1, images + self.dataset.size_batchs.get(self.size, 0), cost + time.time() - self.start)
 
-    return [
+    def on_epoch_end(self, epoch, logs=None):
+        for size, (steps, images, cost) in sorted(self.stats.items()):
+            print("size: %d steps: %d steps/sec: %.2f images/sec: %.1f" % (size, steps, steps / cost, images / cost))
+
+
+def get_callbacks(params, dataset=None):
+
+    callbacks = [
         ModelCheckpoint(params.save_path, monitor='val_loss', verbose=1, save_best_only=True, save_weights_only=True, mode='min'),
         TensorBoard(log_dir=params.log_dir, write_images=True, update_freq='epoch'),
         tfmot.sparsity.keras.PruningSummaries("./log")
     ]
+    if dataset is not None:
+        callbacks.append(ScaleThroughput(dataset))
+    return callbacks
 
 def build_model(params):
     input = Input(shape=[None, None, params.channel])
@@ -312,22 +370,36 @@ def build_model(params):
     return models
 
 def build_net(params):
-    dataset = Dataset("train", params, pworker=1)
-    testset = Dataset("test", params, pworker=1)
+    if params.loader == "tf":
+        dataset = Dataset("train", params, pworker=0)
+        testset = Dataset("test", params, pworker=0)
+    else:
+        dataset = Dataset("train", params, pworker=1, backend=params.loader)
+        testset = Dataset("test", params, pworker=1, backend=params.loader)
     params.distribution = dataset.sample_nums
 
     models = build_model(params)
     print(models.summary())
     
+    if params.loader == "tf":
+        models.fit(dataset.as_tf_dataset(),
+            steps_per_epoch=dataset.num_batchs, epochs=params.epoch,
+            validation_data=testset.as_tf_dataset(),
+            validation_steps=testset.num_batchs,
+            callbacks=get_callbacks(params)
+        )
+        return
+
     models.fit_generator(dataset.gen_iter(),
         steps_per_epoch=dataset.num_batchs, epochs=params.epoch,
         validation_data=testset.gen_iter(),
         validation_steps=testset.num_batchs,
-        callbacks=get_callbacks(params)
+        callbacks=get_callbacks(params, dataset)
     )
 
 
 if __name__ == "__main__":
     config_gpu()
     params = build_params()
+    configure_profiling(params)
     build_net(params)
@@ -0,0 +1,120 @@
+import os
+import numpy as np
+
+'''
+    pre-parsed annotation index, structure of arrays:
+        paths        unique image paths
+        path_ids     int32 [n]        sample -> path
+        box_offsets  int64 [n + 1]    sample i owns boxes[box_offsets[i]: box_offsets[i + 1]]
+        boxes        int32 [m, 5]     x1, y1, x2, y2, cid
+        scores       float32 [m]      score of "x1,y1,x2,y2,score,cid" detection rows, 1 for "x1,y1,x2,y2,cid"
+    each .ano file is cached next to itself as <ano>.idx.npz, keyed by mtime and size.
+'''
+class AnnotationIndex(object):
+    def __init__(self, paths, path_ids, box_offsets, boxes, scores):
+        self.paths = paths
+        self.path_ids = path_ids
+        self.box_offsets = box_offsets
+        self.boxes = boxes
+        self.scores = scores
+
+    @classmethod
+    def from_files(cls, anno_paths, cache=True):
+        if isinstance(anno_paths, str):
+            anno_paths = anno_paths.split(",")
+        parts = [cls.load(path, cache) for path in anno_paths]
+        if len(parts) == 1:
+            return parts[0]
+
+        path_base = np.cumsum([0] + [len(part.paths) for part in parts[:-1]])
+        box_base = np.cumsum([0] + [len(part.boxes) for part in parts[:-1]])
+        return cls(np.concatenate([part.paths for part in parts]),
+            np.concatenate([part.path_ids + base for part, base in zip(parts, path_base)]).astype(np.int32),
+            np.concatenate([[0]] + [part.box_offsets[1:] + base for part, base in zip(parts, box_base)]).astype(np.int64),
+            np.concatenate([part.boxes for part in parts], axis=0),
+            np.concatenate([part.scores for part in parts]))
+
+    @classmethod
+    def load(cls, anno_path, cache=True):
+        stat = os.stat(anno_path)
+        key = np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+        cache_path = anno_path + ".idx.npz"
+        if cache and os.path.exists(cache_path):
+            with np.load(cache_path) as data:
+                if np.array_equal(data["key"], key) and "scores" in data:
+                    return cls(data["paths"], data["path_ids"], data["box_offsets"], data["boxes"], data["scores"])
+
+        index = cls.parse(anno_path)
+        if cache:
+            try:
+                with open(cache_path, "wb") as fd:
+                    np.savez(fd, key=key, paths=index.paths, path_ids=index.path_ids,
+                             box_offsets=index.box_offsets, boxes=index.boxes, scores=index.scores)
+            except OSError as e:
+                print("can not write annotation cache %s: %s" % (cache_path, e))
+        return index
+
+    @classmethod
+    def parse(cls, anno_path, chunk_lines=100000):
+        '''
+            line: "../XX/XX/\d+.jpg x1,y1,x2,y2,cid x1,y1,x2,y2,cid ...."
+            detection files may carry a score per box: "x1,y1,x2,y2,score,cid"
+            box tokens are converted every chunk_lines lines, so only one chunk of str tokens
+            is alive at a time
+        '''
+        paths, counts, tokens, chunks = [], [], [], []
+        with open(anno_path, 'r') as fd:
+            for line in fd:
+                line = line.split()
+                if len(line) == 0:
+                    continue
+                paths.append(line[0])
+                counts.append(len(line) - 1)
+                tokens += line[1:]
+                if len(paths) % chunk_lines == 0:
+                    chunks.append(cls.parse_boxes(anno_path, tokens))
+                    tokens = []
+        chunks.append(cls.parse_boxes(anno_path, tokens))
+        boxes = np.concatenate([boxes for boxes, _ in chunks], axis=0)
+        scores = np.concatenate([scores for _, scores in chunks])
+
+        paths, path_ids = np.unique(np.array(paths, dtype=str), return_inverse=True)
+        box_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return cls(paths, path_ids.astype(np.int32), box_offsets, boxes, scores)
+
+    @staticmethod
+    def parse_boxes(anno_path, tokens):
+        '''
+            box tokens -> int32 [m, 5] boxes, float32 [m] scores
+        '''
+        values = np.array(",".join(tokens).split(",") if tokens else [], dtype=np.float64)
+        fields = np.fromiter((token.count(",") + 1 for token in tokens), dtype=np.int64, count=len(tokens))
+        if np.any((fields != 5) & (fields != 6)):
+            raise ValueError("%s: every box must be x1,y1,x2,y2,cid or x1,y1,x2,y2,score,cid" % anno_path)
+        if np.all(fields == 5):
+            boxes = values.reshape((-1, 5))
+            return boxes.astype(np.int32), np.ones(len(boxes), dtype=np.float32)
+
+        starts = np.cumsum(fields) - fields
+        boxes = np.concatenate([values[starts[:, np.newaxis] + np.arange(4)],
+                                values[starts + fields - 1, np.newaxis]], axis=-1)
+        scores = np.where(fields == 6, values[np.minimum(starts + 4, len(values) - 1)], 1)
+        return boxes.astype(np.int32), scores.astype(np.float32)
+
+    def __len__(self):
+        return len(self.path_ids)
+
+    def path(self, idx):
+        return str(self.paths[self.path_ids[idx]])
+
+    def sample_boxes(self, idx):
+        return self.boxes[self.box_offsets[idx]: self.box_offsets[idx + 1]]
+
+    def box_counts(self):
+        return np.diff(self.box_offsets)
+
+    def box_sample_ids(self):
+        return np.repeat(np.arange(len(self)), self.box_counts())
+
+    def class_hist(self, class_num):
+        return np.bincount(self.boxes[:, 4], minlength=class_num)
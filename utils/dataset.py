@@ -4,17 +4,68 @@ import random
 import numpy as np
 import tensorflow as tf
 import threading
+import multiprocessing as mp
 from queue import Queue
+from collections import deque
 from .utils import image_preporcess 
+from .shards import ShardReader
+from .annotation import AnnotationIndex
+from .profiling import span, profiled
+
+
+class SharedBatchRing(object):
+    """
+        preallocated shared-memory batch slots for process workers.
+        workers fill a free slot in-place and publish (slot, input_size),
+        the consumer copies the batch out and hands the slot back.
+        size_batchs: {input_size: batch_size}, slots are sized for the largest batch
+    """
+    def __init__(self, slot_num, size_batchs, channel_num, strides, anchor_per_scale, num_classes):
+        self.size_batchs = size_batchs
+        self.channel_num = channel_num
+        self.strides = strides
+        self.label_depth = (anchor_per_scale, 5 + num_classes)
+        capacity = np.max([[np.prod(shape) for shape in self.shapes(size)] for size in size_batchs], axis=0)
+        self.slots = []
+        for _ in range(slot_num):
+            self.slots.append([np.frombuffer(mp.RawArray("f", int(cap)), dtype=np.float32) for cap in capacity])
+
+        self.free_slots = mp.Queue()
+        self.ready_slots = mp.Queue()
+        for slot in range(slot_num):
+            self.free_slots.put(slot)
+
+    def shapes(self, input_size):
+        batch_size = self.size_batchs[input_size]
+        return [(batch_size, input_size, input_size, self.channel_num)] + \
+               [(batch_size, input_size // stride, input_size // stride) + self.label_depth for stride in self.strides]
+
+    def views(self, slot, input_size):
+        return [buf[:int(np.prod(shape))].reshape(shape) for buf, shape in zip(self.slots[slot], self.shapes(input_size))]
+
+    def acquire(self):
+        return self.free_slots.get(block=True)
+
+    def put(self, slot, input_size):
+        self.ready_slots.put((slot, input_size), block=True)
+
+    def get(self, block=True):
+        slot, input_size = self.ready_slots.get(block=block)
+        image, label_mbbox, label_lbbox = [np.array(view) for view in self.views(slot, input_size)]
+        self.free_slots.put(slot)
+        return image, [label_mbbox, label_lbbox]
+
 
 class Dataset(object):
     """implement Dataset here"""
-    def __init__(self, dataset_type, params, sample_rate=1.0, pworker=3):
+    def __init__(self, dataset_type, params, sample_rate=1.0, pworker=3, backend="thread"):
         self.anno_paths  = (params.train_ano if dataset_type == "train" else params.test_ano).split(",")
         self.batch_size  = params.batch_size
         self.channel_num  = params.channel
 
         self.data_aug    = True if dataset_type == "train" else False
+        self.fused_aug = True
+        self.batch_dtype = np.float32  # thread backend batches, the process ring is float32
         self.canny = params.canny
         self.sample_rate = sample_rate
 
@@ -25,33 +76,73 @@ class Dataset(object):
         self.anchor_per_scale = 3
         self.max_bbox_per_scale = 150
         self.sample_nums = [0] * params.class_num
+        self.shards = ShardReader(os.path.join(params.shard_dir, dataset_type)) if params.shard_dir else None
 
         self.annotations = self.load_annotations(dataset_type)
         self.num_samples = len(self.annotations)
-        self.num_batchs = int(np.ceil(1.0 * self.num_samples / self.batch_size * self.sample_rate))
-        self.read_index = 0
-        self.queue = Queue(32)
+        self.size_batchs = self.schedule_batch_sizes(params)
+        mean_batch_size = np.mean(list(self.size_batchs.values()))
+        self.num_batchs = int(np.ceil(1.0 * self.num_samples / mean_batch_size * self.sample_rate))
+        self.handed_sizes = deque(maxlen=1024)
         self.pworker = pworker
-        self.lock = threading.Lock()
-        self.threads = [threading.Thread(target=self.produce_task).start() for x in range(self.pworker)]
-        
-
+        self.backend = backend
+
+        if backend == "process":
+            # index state is shared so that every worker walks the same epoch order
+            self.read_value = mp.RawValue("l", 0)
+            self.step_value = mp.RawValue("l", 0)
+            self.order = np.frombuffer(mp.RawArray("l", self.num_samples), dtype=np.int_)
+            self.order[:] = np.arange(self.num_samples)
+            self.size_schedule = np.frombuffer(mp.RawArray("l", self.num_batchs), dtype=np.int_)
+            self.shuffle_size_schedule()
+            self.lock = mp.Lock()
+            self.queue = SharedBatchRing(2 * self.pworker + 2, self.size_batchs,
+                self.channel_num, self.strides, self.anchor_per_scale, self.num_classes)
+            self.threads = [mp.Process(target=self.produce_process, daemon=True) for x in range(self.pworker)]
+            for worker in self.threads:
+                worker.start()
+        elif backend == "thread":
+            self.read_value = mp.RawValue("l", 0)
+            self.step_value = mp.RawValue("l", 0)
+            self.order = np.arange(self.num_samples)
+            self.size_schedule = np.zeros(self.num_batchs, dtype=np.int_)
+            self.shuffle_size_schedule()
+            self.queue = Queue(32)
+            self.lock = threading.Lock()
+            self.threads = [threading.Thread(target=self.produce_task).start() for x in range(self.pworker)]
+        else:
+            raise ValueError("unknown backend: %s" % backend)
+
+
+
+    def schedule_batch_sizes(self, params):
+        '''
+            batch size per input size. with pixel_budget_size every step carries about
+            batch_size * pixel_budget_size ** 2 pixels, otherwise batch_size for all sizes.
+        '''
+        if not params.pixel_budget_size:
+            return {int(size): self.batch_size for size in self.train_input_sizes}
+        budget = 1.0 * self.batch_size * params.pixel_budget_size ** 2
+        return {int(size): int(np.clip(np.round(budget / size ** 2), 1, params.max_batch_size))
+                for size in self.train_input_sizes}
+
+    def shuffle_size_schedule(self):
+        '''
+            input size of every step in the epoch, each size gets an equal share of the steps.
+            workers pull the next entry together with read_index, so a step's samples and
+            its size are reserved at once and steps_per_epoch matches the planned batch sizes.
+        '''
+        sizes = np.tile(self.train_input_sizes, int(np.ceil(1.0 * self.num_batchs / len(self.train_input_sizes))))
+        self.size_schedule[:] = sizes[:self.num_batchs]
+        np.random.shuffle(self.size_schedule)
 
     def load_annotations(self, dataset_type):
-        annotations = []
-        for path in self.anno_paths:
-            with open(path, 'r') as f:
-                txt = f.readlines()
-                annotations += [line.strip() for line in txt if len(line.strip().split()) != 0]
-        
-        cls_ids = []
-        for ano in annotations:
-            ano = ano.split()
-            if len(ano[1:]) > 0:
-                cls_ids += map(lambda x: int(x.split(",")[4]), ano[1:])
-        for cls_id in cls_ids:
-            self.sample_nums[cls_id] += 1
+        # annotations are sample ids into the shards or the parsed annotation index
+        self.index = None if self.shards is not None else AnnotationIndex.from_files(self.anno_paths)
+        source = self.shards if self.shards is not None else self.index
+        self.sample_nums = source.class_hist(self.num_classes).tolist()
         print("!!!!!!", self.sample_nums)
+        annotations = np.arange(len(source))
         np.random.shuffle(annotations)
         return annotations
 
@@ -70,39 +161,54 @@ class Dataset(object):
                 yield x
 
     @property
-    def batch_count(self):
-        return self.read_index // self.batch_size
+    def read_index(self):
+        return self.read_value.value
 
-    def produce(self):
-        train_input_size = random.choice(self.train_input_sizes)
-        train_output_sizes = train_input_size // self.strides
+    @read_index.setter
+    def read_index(self, value):
+        self.read_value.value = value
 
-        batch_image = np.zeros((self.batch_size, train_input_size, train_input_size, self.channel_num))
+    @property
+    def batch_count(self):
+        return self.step_value.value
+
+    @profiled("dataset_produce")
+    def produce(self, ring_slot=None):
+        with self.lock:
+            # workers that run ahead into the next epoch wrap around the schedule
+            train_input_size = int(self.size_schedule[self.batch_count % self.num_batchs])
+            batch_size = self.size_batchs[train_input_size]
+            start_index = self.read_index
+            self.read_index += batch_size
+            self.step_value.value += 1
+        train_output_sizes = train_input_size // self.strides
 
-        batch_label_mbbox = np.zeros((self.batch_size, train_output_sizes[0], train_output_sizes[0],
-                                      self.anchor_per_scale, 5 + self.num_classes))
-        batch_label_lbbox = np.zeros((self.batch_size, train_output_sizes[1], train_output_sizes[1],
-                                      self.anchor_per_scale, 5 + self.num_classes))
+        if ring_slot is not None:
+            batch_image, batch_label_mbbox, batch_label_lbbox = self.queue.views(ring_slot, train_input_size)
+            batch_label_mbbox[...] = 0
+            batch_label_lbbox[...] = 0
+        else:
+            batch_image = np.zeros((batch_size, train_input_size, train_input_size, self.channel_num), dtype=self.batch_dtype)
 
-        batch_mbboxes = np.zeros((self.batch_size, self.max_bbox_per_scale, 4))
-        batch_lbboxes = np.zeros((self.batch_size, self.max_bbox_per_scale, 4))
+            batch_label_mbbox = np.zeros((batch_size, train_output_sizes[0], train_output_sizes[0],
+                                          self.anchor_per_scale, 5 + self.num_classes), dtype=self.batch_dtype)
+            batch_label_lbbox = np.zeros((batch_size, train_output_sizes[1], train_output_sizes[1],
+                                          self.anchor_per_scale, 5 + self.num_classes), dtype=self.batch_dtype)
 
         num = 0
-        while num < self.batch_size:
-            with self.lock:
-                self.read_index += 1
-                index = self.read_index
-            if index >= self.num_samples: index %= self.num_samples
-            annotation = self.annotations[index]
-            image, bboxes = self.parse_annotation(annotation, train_input_size)
-
-            label_mbbox, label_lbbox  = self.preprocess_true_boxes(bboxes, train_output_sizes)
+        batch_bboxes = []
+        while num < batch_size:
+            index = (start_index + num + 1) % self.num_samples
+            annotation = self.annotations[self.order[index]]
+            with span("dataset_parse"):
+                image, bboxes = self.parse_annotation(annotation, train_input_size)
 
             batch_image[num, :, :, :] = image
-            batch_label_mbbox[num, :, :, :, :] = label_mbbox
-            batch_label_lbbox[num, :, :, :, :] = label_lbbox
+            batch_bboxes.append(bboxes)
             num += 1
 
+        with span("dataset_labels"):
+            self.preprocess_true_boxes_batch(batch_bboxes, train_output_sizes, [batch_label_mbbox, batch_label_lbbox])
         return batch_image, [batch_label_mbbox, batch_label_lbbox]
 
     def produce_task(self):
@@ -110,13 +216,26 @@ class Dataset(object):
             result = self.produce()
             self.queue.put(result, block=True)
 
+    def produce_process(self):
+        # forked workers inherit the parent's random state
+        random.seed()
+        np.random.seed()
+        while(True):
+            slot = self.queue.acquire()
+            batch_image, _ = self.produce(slot)
+            self.queue.put(slot, batch_image.shape[1])
+
     def __next__(self):
         if self.batch_count < self.num_batchs:
-            return self.queue.get(block=True)
+            result = self.queue.get(block=True)
+            self.handed_sizes.append(result[0].shape[1])
+            return result
         else:
             with self.lock:
                 self.read_index = 0
-                np.random.shuffle(self.annotations)
+                self.step_value.value = 0
+                np.random.shuffle(self.order)
+                self.shuffle_size_schedule()
             raise StopIteration
            
 
@@ -185,7 +304,7 @@ class Dataset(object):
             ones = np.ones(shape=(len(points), 1))
 
             points_ones = np.hstack([points, ones])
-            rpoints = rot_mat.dot(points_ones.T).T.astype(np.int)
+            rpoints = rot_mat.dot(points_ones.T).T.astype(int)
             rpoints[:, 0] = np.clip(rpoints[:, 0], 0, width)
             rpoints[:, 1] = np.clip(rpoints[:, 1], 0, height)
             lu, rd = (min(rpoints[:, 0]), min(rpoints[:, 1])), (max(rpoints[:, 0]), max(rpoints[:, 1]))
@@ -222,14 +341,116 @@ class Dataset(object):
 
         return image, bboxes
 
+    def load_sample(self, annotation):
+        if self.shards is not None:
+            return self.shards[annotation]
+        image_path = self.index.path(annotation)
+        image = cv2.imread(image_path)
+        if image is None:
+            raise KeyError("%s does not exist ... " %image_path)
+        return image, self.index.sample_boxes(annotation)
+
+    def fused_augment(self, image, bboxes, train_input_size):
+        """
+            flip -> crop -> translate -> rotate -> color -> letterbox in a single warpAffine.
+            random draws follow the chained methods, boxes are updated the same way;
+            the crop/translate validity region becomes the source roi so the border stays black.
+            return: letterboxed uint8 bgr image, bboxes
+        """
+        h, w, _ = image.shape
+        bboxes = np.array(bboxes)
+        has_box = len(bboxes) > 0
+        trans = np.eye(3)
+
+        # flip
+        flipped = random.random() < 0.5
+        if flipped:
+            trans = np.array([[-1, 0, w - 1], [0, 1, 0], [0, 0, 1]]).dot(trans)
+            if has_box:
+                bboxes[:, [0,2]] = w - bboxes[:, [2,0]]
+
+        # crop, a shift of the origin plus a smaller frame
+        crop_xmin, crop_ymin = 0, 0
+        if random.random() < 0.8:
+            if has_box:
+                max_bbox = np.concatenate([np.min(bboxes[:, 0:2], axis=0), np.max(bboxes[:, 2:4], axis=0)], axis=-1)
+            else:
+                max_bbox = np.array([random.uniform(0, 0.15)] * 2 + [random.uniform(0.85, 1)] * 2) * np.array([w, h, w, h])
+
+            crop_xmin = max(0, int(max_bbox[0] - random.uniform(0, max_bbox[0])))
+            crop_ymin = max(0, int(max_bbox[1] - random.uniform(0, max_bbox[1])))
+            crop_xmax = min(w, int(max_bbox[2] + random.uniform(0, w - max_bbox[2])))
+            crop_ymax = min(h, int(max_bbox[3] + random.uniform(0, h - max_bbox[3])))
+            trans = np.array([[1, 0, -crop_xmin], [0, 1, -crop_ymin], [0, 0, 1]]).dot(trans)
+            w, h = crop_xmax - crop_xmin, crop_ymax - crop_ymin
+            if has_box:
+                bboxes[:, [0, 2]] = bboxes[:, [0, 2]] - crop_xmin
+                bboxes[:, [1, 3]] = bboxes[:, [1, 3]] - crop_ymin
+
+        # translate
+        tx, ty = 0, 0
+        if random.random() < 0.8:
+            if has_box:
+                max_bbox = np.concatenate([np.min(bboxes[:, 0:2], axis=0), np.max(bboxes[:, 2:4], axis=0)], axis=-1)
+            else:
+                max_bbox = np.array([random.uniform(0, 0.15)] * 2 + [random.uniform(0.85, 1)] * 2) * np.array([w, h, w, h])
+
+            tx = random.uniform(-(max_bbox[0] - 1), (w - max_bbox[2] - 1))
+            ty = random.uniform(-(max_bbox[1] - 1), (h - max_bbox[3] - 1))
+            trans = np.array([[1, 0, tx], [0, 1, ty], [0, 0, 1]]).dot(trans)
+            if has_box:
+                bboxes[:, [0, 2]] = bboxes[:, [0, 2]] + tx
+                bboxes[:, [1, 3]] = bboxes[:, [1, 3]] + ty
+
+        # pixels that survive crop + translate, in crop coordinates
+        roi = [max(0, -tx), max(0, -ty), min(w, w - tx), min(h, h - ty)]
+
+        # rotate
+        if random.uniform(0, 1) < 0.8:
+            rot_mat = cv2.getRotationMatrix2D((w // 2, h // 2), random.uniform(-10, 10), 1)
+            trans = np.concatenate([rot_mat, [[0, 0, 1]]]).dot(trans)
+            if has_box:
+                corners = bboxes[:, [0, 1, 2, 1, 0, 3, 2, 3]].reshape((-1, 4, 2)).astype(np.float32)
+                rpoints = (corners.dot(rot_mat[:, :2].T) + rot_mat[:, 2]).astype(np.int64)
+                rpoints[..., 0] = np.clip(rpoints[..., 0], 0, w)
+                rpoints[..., 1] = np.clip(rpoints[..., 1], 0, h)
+                bboxes[:, :4] = np.concatenate([rpoints.min(axis=1), rpoints.max(axis=1)], axis=-1)
+
+        # letterbox
+        scale = min(1.0 * train_input_size / w, 1.0 * train_input_size / h)
+        nw, nh = int(scale * w), int(scale * h)
+        dw, dh = (train_input_size - nw) // 2, (train_input_size - nh) // 2
+        trans = np.array([[scale, 0, 0], [0, scale, 0], [0, 0, 1]]).dot(trans)
+        if has_box:
+            bboxes[:, [0, 2]] = bboxes[:, [0, 2]] * scale + dw
+            bboxes[:, [1, 3]] = bboxes[:, [1, 3]] * scale + dh
+
+        # roi back to source coordinates
+        src_w = image.shape[1]
+        x0, x1 = int(np.ceil(roi[0] + crop_xmin)), int(np.floor(roi[2] + crop_xmin))
+        y0, y1 = int(np.ceil(roi[1] + crop_ymin)), int(np.floor(roi[3] + crop_ymin))
+        if flipped:
+            x0, x1 = src_w - x1, src_w - x0
+        trans = trans.dot(np.array([[1, 0, x0], [0, 1, y0], [0, 0, 1]]))
+
+        image = cv2.warpAffine(image[y0:y1, x0:x1], trans[:2], (nw, nh), borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        if random.random() < 0.5:
+            image = cv2.convertScaleAbs(image, alpha=random.uniform(0.5, 2.5), beta=random.uniform(-50, 50))
+        image = cv2.copyMakeBorder(image, dh, train_input_size - nh - dh, dw, train_input_size - nw - dw,
+                cv2.BORDER_CONSTANT, value=(128, 128, 128))
+        return image, bboxes
+
     def parse_annotation(self, annotation, train_input_size):
         # non-box, all 0
-        line = annotation.split()
-        image_path = line[0]
-        if not os.path.exists(image_path):
-            raise KeyError("%s does not exist ... " %image_path)
-        image = np.array(cv2.imread(image_path))
-        bboxes = np.array([list(map(lambda x: int(float(x)), box.split(','))) for box in line[1:]])
+        image, bboxes = self.load_sample(annotation)
+
+        if self.data_aug and self.fused_aug:
+            image, bboxes = self.fused_augment(image, bboxes, train_input_size)
+            if self.canny:
+                image = image_preporcess(image, [train_input_size, train_input_size], canny=self.canny)
+            else:
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB).astype(np.float32)
+            return image, bboxes
 
         if self.data_aug:
             image, bboxes = self.random_horizontal_flip(np.copy(image), np.copy(bboxes))
@@ -275,7 +496,7 @@ class Dataset(object):
             bbox_coor = bbox[:4]
             bbox_class_ind = bbox[4]
 
-            onehot = np.zeros(self.num_classes, dtype=np.float)
+            onehot = np.zeros(self.num_classes, dtype=float)
             onehot[bbox_class_ind] = 1.0
             uniform_distribution = np.full(self.num_classes, 1.0 / self.num_classes)
             deta = 0.01
@@ -331,5 +552,181 @@ class Dataset(object):
         label_mbbox, label_lbbox = label
         return label_mbbox, label_lbbox
 
+    def preprocess_true_boxes_batch(self, batch_bboxes, train_output_sizes, batch_labels=None):
+        """
+            vectorized preprocess_true_boxes over a whole batch, labels are identical.
+            batch_bboxes: list of [n, 5] boxes (x1, y1, x2, y2, cid), one per image
+            batch_labels: [label_mbbox, label_lbbox] of shape [b, s, s, 3, 5 + cn], filled in-place
+        """
+        batch_size = len(batch_bboxes)
+        if batch_labels is None:
+            batch_labels = [np.zeros((batch_size, train_output_sizes[i], train_output_sizes[i], self.anchor_per_scale,
+                                      5 + self.num_classes)) for i in range(2)]
+
+        counts = [len(bboxes) for bboxes in batch_bboxes]
+        if sum(counts) == 0:
+            return batch_labels
+        bboxes = np.concatenate([np.reshape(bboxes, (-1, 5)) for bboxes in batch_bboxes if len(bboxes)], axis=0)
+        batch_ind = np.repeat(np.arange(batch_size), counts)
+        box_num = len(bboxes)
+
+        bbox_coor = bboxes[:, :4]
+        deta = 0.01
+        uniform_distribution = np.full(self.num_classes, 1.0 / self.num_classes)
+        smooth_onehot = np.eye(self.num_classes)[bboxes[:, 4].astype(np.int64)] * (1 - deta) + deta * uniform_distribution
+
+        bbox_xywh = np.concatenate([(bbox_coor[:, 2:] + bbox_coor[:, :2]) * 0.5, bbox_coor[:, 2:] - bbox_coor[:, :2]], axis=-1)
+        bbox_xywh_scaled = 1.0 * bbox_xywh[:, np.newaxis, :] / self.strides[np.newaxis, :, np.newaxis]  # [n, 2, 4]
+        grid_xy = np.floor(bbox_xywh_scaled[..., 0:2]).astype(np.int32)  # [n, 2, (x, y)]
+
+        anchors_xywh = np.zeros((box_num, 2, self.anchor_per_scale, 4))
+        anchors_xywh[..., 0:2] = grid_xy[:, :, np.newaxis, :] + 0.5
+        anchors_xywh[..., 2:4] = self.anchors[np.newaxis, :2]
+
+        iou = self.bbox_iou(bbox_xywh_scaled[:, :, np.newaxis, :], anchors_xywh)  # [n, 2, 3]
+        iou_mask = iou > 0.3
+
+        # boxes without any positive anchor fall back to the best one,
+        # bounded by the large scale output size as preprocess_true_boxes does
+        best_anchor_ind = np.argmax(np.reshape(iou, (box_num, -1)), axis=-1)
+        best_detect = best_anchor_ind // self.anchor_per_scale
+        best_anchor = best_anchor_ind % self.anchor_per_scale
+        best_xy = grid_xy[np.arange(box_num), best_detect]
+        fallback = ~np.any(iou_mask, axis=(1, 2)) & np.all(train_output_sizes[1] > best_xy, axis=-1)
+
+        rows = np.concatenate([bbox_xywh, np.ones((box_num, 1)), smooth_onehot], axis=-1)
+        for i in range(2):
+            output_size = train_output_sizes[i]
+            pos_box, pos_anchor = np.nonzero(iou_mask[:, i, :])
+            fb_box = np.nonzero(fallback & (best_detect == i))[0]
+            box_ind = np.concatenate([pos_box, fb_box])
+            anchor_ind = np.concatenate([pos_anchor, best_anchor[fb_box]])
+            if len(box_ind) == 0:
+                continue
+            # later boxes overwrite earlier ones on the same cell
+            order = np.argsort(box_ind, kind="stable")
+            box_ind, anchor_ind = box_ind[order], anchor_ind[order]
+
+            xind, yind = grid_xy[box_ind, i, 0], grid_xy[box_ind, i, 1]
+            out_range = (xind >= output_size) | (yind >= output_size) | (xind < -output_size) | (yind < -output_size)
+            if np.any(out_range):
+                raise IndexError("boxes out of grid %d: %s" % (output_size, bboxes[box_ind[out_range]]))
+            xind, yind = xind % output_size, yind % output_size
+
+            flat_ind = ((batch_ind[box_ind] * output_size + yind) * output_size + xind) * self.anchor_per_scale + anchor_ind
+            _, last = np.unique(flat_ind[::-1], return_index=True)
+            keep = len(flat_ind) - 1 - last
+
+            box_ind = box_ind[keep]
+            batch_labels[i][batch_ind[box_ind], yind[keep], xind[keep], anchor_ind[keep], :] = rows[box_ind]
+
+        return batch_labels
+
+    def tf_max_bbox(self, bboxes, w, h):
+        return tf.cond(tf.shape(bboxes)[0] > 0,
+            lambda: tf.concat([tf.reduce_min(bboxes[:, 0:2], axis=0), tf.reduce_max(bboxes[:, 2:4], axis=0)], axis=0),
+            lambda: tf.stack([tf.random.uniform([], 0, 0.15)] * 2 + [tf.random.uniform([], 0.85, 1)] * 2) * tf.stack([w, h, w, h]))
+
+    def tf_augment(self, image, bboxes):
+        """
+            tf ops version of random_horizontal_flip, random_crop, random_translate and color_switch.
+            image: uint8 [h, w, 3], bboxes: float32 [n, 5]
+        """
+        h, w = tf.cast(tf.shape(image)[0], tf.float32), tf.cast(tf.shape(image)[1], tf.float32)
+
+        flip = tf.random.uniform([]) < 0.5
+        image = tf.cond(flip, lambda: tf.image.flip_left_right(image), lambda: image)
+        bboxes = tf.cond(flip, lambda: tf.stack([w - bboxes[:, 2], bboxes[:, 1], w - bboxes[:, 0], bboxes[:, 3], bboxes[:, 4]], axis=1),
+                         lambda: bboxes)
+
+        max_bbox = self.tf_max_bbox(bboxes, w, h)
+        crop = tf.random.uniform([]) < 0.8
+        crop_xmin = tf.maximum(0., tf.floor(max_bbox[0] - tf.random.uniform([], 0, max_bbox[0])))
+        crop_ymin = tf.maximum(0., tf.floor(max_bbox[1] - tf.random.uniform([], 0, max_bbox[1])))
+        crop_xmax = tf.minimum(w, tf.floor(max_bbox[2] + tf.random.uniform([], 0, w - max_bbox[2])))
+        crop_ymax = tf.minimum(h, tf.floor(max_bbox[3] + tf.random.uniform([], 0, h - max_bbox[3])))
+        crop_rect = tf.cast(tf.where(crop, tf.stack([crop_xmin, crop_ymin, crop_xmax, crop_ymax]), tf.stack([0., 0., w, h])), tf.int32)
+        image = image[crop_rect[1]: crop_rect[3], crop_rect[0]: crop_rect[2]]
+        bboxes = bboxes - tf.cast(tf.stack([crop_rect[0], crop_rect[1], crop_rect[0], crop_rect[1], 0]), tf.float32)
+
+        h, w = tf.cast(tf.shape(image)[0], tf.float32), tf.cast(tf.shape(image)[1], tf.float32)
+        max_bbox = self.tf_max_bbox(bboxes, w, h)
+        translate = tf.random.uniform([]) < 0.8
+        tx = tf.random.uniform([], -(max_bbox[0] - 1), w - max_bbox[2] - 1)
+        ty = tf.random.uniform([], -(max_bbox[1] - 1), h - max_bbox[3] - 1)
+        shift = tf.cast(tf.round(tf.where(translate, tf.stack([tx, ty]), tf.zeros([2]))), tf.int32)
+        pad_x, pad_y = tf.abs(shift[0]), tf.abs(shift[1])
+        image = tf.pad(image, [[pad_y, pad_y], [pad_x, pad_x], [0, 0]])
+        image = image[pad_y - shift[1]: pad_y - shift[1] + tf.shape(image)[0] - 2 * pad_y,
+                      pad_x - shift[0]: pad_x - shift[0] + tf.shape(image)[1] - 2 * pad_x]
+        bboxes = bboxes + tf.cast(tf.stack([shift[0], shift[1], shift[0], shift[1], 0]), tf.float32)
+
+        image = tf.cast(image, tf.float32)
+        color = tf.random.uniform([]) < 0.5
+        alpha, beta = tf.random.uniform([], 0.5, 2.5), tf.random.uniform([], -50, 50)
+        image = tf.cond(color, lambda: tf.clip_by_value(tf.round(tf.abs(image * alpha + beta)), 0, 255), lambda: image)
+        return image, bboxes
+
+    def tf_letterbox(self, image, bboxes, input_size):
+        h, w = tf.cast(tf.shape(image)[0], tf.float32), tf.cast(tf.shape(image)[1], tf.float32)
+        size = tf.cast(input_size, tf.float32)
+        scale = tf.minimum(size / w, size / h)
+        nw, nh = tf.cast(scale * w, tf.int32), tf.cast(scale * h, tf.int32)
+        dw, dh = (input_size - nw) // 2, (input_size - nh) // 2
+        image = tf.image.resize(tf.cast(image, tf.float32), [nh, nw])
+        image = tf.pad(image - 128.0, [[dh, input_size - nh - dh], [dw, input_size - nw - dw], [0, 0]]) + 128.0
+        offset = tf.cast(tf.stack([dw, dh, dw, dh]), tf.float32)
+        bboxes = tf.concat([tf.floor(bboxes[:, :4] * scale + offset), bboxes[:, 4:]], axis=1)
+        return image, bboxes
+
+    def tf_labels(self, input_size, bboxes):
+        output_sizes = input_size // self.strides
+        batch_labels = [np.zeros((len(bboxes), size, size, self.anchor_per_scale, 5 + self.num_classes), dtype=np.float32)
+                        for size in output_sizes]
+        self.preprocess_true_boxes_batch([boxes[boxes[:, 4] >= 0].astype(np.int32) for boxes in bboxes], output_sizes, batch_labels)
+        return batch_labels
+
+    def as_tf_dataset(self, seed=None):
+        """
+            tf.data pipeline over the annotation index. jpeg decode, augmentation and letterbox run in
+            parallel map calls, labels come from preprocess_true_boxes_batch in a numpy_function.
+            every batch_size consecutive samples share one random input size.
+            rotate has no tf op and is skipped, canny and shards stay on the python loaders.
+        """
+        if self.canny or self.index is None or len(set(self.size_batchs.values())) > 1:
+            raise ValueError("as_tf_dataset reads jpegs with a fixed batch size and no canny channel")
+
+        seed = np.random.randint(1 << 30) if seed is None else seed
+        batch_size = self.batch_size
+        paths = tf.constant(self.index.paths[self.index.path_ids])
+        boxes = tf.constant(self.index.boxes, dtype=tf.float32)
+        box_offsets = tf.constant(self.index.box_offsets)
+        input_sizes = tf.constant(self.train_input_sizes, dtype=tf.int32)
+
+        def load(step, idx):
+            size_ind = tf.random.stateless_uniform([], seed=tf.stack([tf.constant(seed, tf.int64), step // batch_size]),
+                                                   maxval=len(self.train_input_sizes), dtype=tf.int32)
+            image = tf.image.decode_jpeg(tf.io.read_file(paths[idx]), channels=3)
+            bboxes = boxes[box_offsets[idx]: box_offsets[idx + 1]]
+            if self.data_aug:
+                image, bboxes = self.tf_augment(image, bboxes)
+            image, bboxes = self.tf_letterbox(image, bboxes, input_sizes[size_ind])
+            bboxes = bboxes[:self.max_bbox_per_scale]
+            bboxes = tf.pad(bboxes, [[0, self.max_bbox_per_scale - tf.shape(bboxes)[0]], [0, 0]], constant_values=-1)
+            return image, bboxes
+
+        def assign(images, bboxes):
+            label_mbbox, label_lbbox = tf.numpy_function(self.tf_labels, [tf.shape(images)[1], bboxes], [tf.float32, tf.float32])
+            label_mbbox.set_shape([batch_size, None, None, self.anchor_per_scale, 5 + self.num_classes])
+            label_lbbox.set_shape([batch_size, None, None, self.anchor_per_scale, 5 + self.num_classes])
+            return images, (label_mbbox, label_lbbox)
+
+        data = tf.data.Dataset.from_tensor_slices(np.arange(self.num_samples))
+        data = data.shuffle(self.num_samples, seed=seed, reshuffle_each_iteration=True).repeat().enumerate()
+        data = data.map(load, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        data = data.batch(batch_size, drop_remainder=True)
+        data = data.map(assign, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        return data.prefetch(tf.data.experimental.AUTOTUNE)
+
     def __len__(self):
         return self.num_batchs
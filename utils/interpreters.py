@@ -0,0 +1,76 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class InterpreterEntry(object):
+    """
+    one allocated interpreter, lock must be held from set_tensor to the last get_tensor
+    """
+
+    def __init__(self, interpreter):
+        self.interpreter = interpreter
+        self.lock = threading.Lock()
+        # image input is 4-d, org_shape is 1-d; predictions / detections come before the scalar valid
+        self.inputs = sorted(interpreter.get_input_details(), key=lambda d: -len(d['shape']))
+        self.outputs = sorted(interpreter.get_output_details(), key=lambda d: -len(d['shape']))
+
+
+class InterpreterCache(object):
+    """
+    LRU of allocated tflite interpreters keyed by input size, all sharing one model buffer.
+    Sizes other than the exported one need a resizable input (freeze --tflite_dynamic),
+    they are made with resize_tensor_input + allocate_tensors on first use.
+    """
+
+    def __init__(self, model_path, capacity=4, num_threads=None):
+        import tensorflow as tf
+        with open(model_path, "rb") as fd:
+            self.content = fd.read()
+        self.make = lambda: tf.lite.Interpreter(model_content=self.content, num_threads=num_threads)
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        detail = InterpreterEntry(self.make()).inputs[0]
+        self.shape = [int(v) for v in detail['shape']]
+        self.resizable = bool((np.array(detail.get('shape_signature', self.shape))[1:3] == -1).any())
+
+    def build(self, input_size):
+        interpreter = self.make()
+        detail = InterpreterEntry(interpreter).inputs[0]
+        shape = self.shape[:1] + [input_size, input_size] + self.shape[3:]
+        if shape != self.shape:
+            if not self.resizable:
+                raise ValueError("tflite input is fixed to %s, export with --tflite_dynamic to run at %d" % (
+                    self.shape, input_size))
+            interpreter.resize_tensor_input(detail['index'], shape)
+        interpreter.allocate_tensors()
+        return InterpreterEntry(interpreter)
+
+    def get(self, input_size):
+        with self.lock:
+            entry = self.entries.get(input_size)
+            if entry is not None:
+                self.entries.move_to_end(input_size)
+                return entry
+
+        # allocation is slow, other sizes keep running meanwhile; a racing build is dropped
+        entry = self.build(input_size)
+        with self.lock:
+            entry = self.entries.setdefault(input_size, entry)
+            self.entries.move_to_end(input_size)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        return entry
+
+    def warmup(self, sizes):
+        '''
+            allocate and run each size once so the first real frame pays no setup
+        '''
+        for input_size in sizes:
+            entry = self.get(input_size)
+            with entry.lock:
+                for detail in entry.inputs:
+                    entry.interpreter.set_tensor(detail['index'], np.zeros(detail['shape'], dtype=detail['dtype']))
+                entry.interpreter.invoke()
@@ -62,13 +62,15 @@ def build_args():
 
     # ------train prams-------
     parser.add_argument('-lr', type=float, default=0.001, help='learn rate')
-    parser.add_argument("--strides", nargs='*', default=[16, 32])
-    parser.add_argument("--train_input_sizes", nargs='*', default=[128, 160, 192, 224, 256, 288, 320, 352, 384, 416])
+    parser.add_argument("--strides", nargs='*', default=[16, 32], type=int)
+    parser.add_argument("--train_input_sizes", nargs='*', default=[128, 160, 192, 224, 256, 288, 320, 352, 384, 416], type=int)
     parser.add_argument("--data_dir", default="./data")
     parser.add_argument("--log_dir", default="./log")
     parser.add_argument("--save_path", default="./models/cp-{epoch:02d}-{val_loss:02f}")
     parser.add_argument("--se", default=False, action="store_true", help="channel attention")
     parser.add_argument("--canny", default=False, action="store_true", help="add a channel except for rgb channel")
+    parser.add_argument("--edge_channel", default=False, action="store_true",
+                        help="compute the canny-like channel inside the model, input stays rgb")
     parser.add_argument("--bn", default=False, action="store_true", help="batch norm")
 
     parser.add_argument("--pretrain_model", default="", help="model path")
@@ -80,17 +82,88 @@ def build_args():
     parser.add_argument("--eval_ano", default="./data/test.ano", help="evaluating anotaion.")
     parser.add_argument("--epoch", default=200, type=int)
     parser.add_argument("--batch_size", default=8, type=int)
+    parser.add_argument("--pixel_budget_size", default=0, type=int, help="scale batch size so each step has batch_size images of this size, 0 is off")
+    parser.add_argument("--max_batch_size", default=64, type=int, help="upper bound of pixel budget batch size")
+    parser.add_argument("--loader", choices=["thread", "process", "tf"], default="thread", help="data loader backend")
+    parser.add_argument("--shard_dir", default="", help="pre-decoded shards made by pack.py, empty reads jpegs")
+    parser.add_argument("--shard_downscale", default=False, action="store_true", help="pack.py: downscale to max train_input_sizes")
     parser.add_argument("--message", "-m", default="", help="extra mesage")
     parser.add_argument("--thres", "-t", default=0.3, type=float)
 
     # ------- test / evaluating params -------
-    parser.add_argument("--mode", choices=["train", "batch", "test", "video", "freeze"], default="video")
+    parser.add_argument("--mode", choices=["train", "batch", "test", "video", "freeze", "serve"], default="video")
     parser.add_argument("--test_input", default=224, type=int)
+    parser.add_argument("--video_source", default="0", help="camera index or video file")
+    parser.add_argument("--pipeline", default=False, action="store_true", help="video: threaded capture/preprocess/inference/render, stale frames dropped")
+    parser.add_argument("--no_show", default=False, action="store_true", help="video: no window, for files and benchmarks")
+    parser.add_argument("--track", default=False, action="store_true", help="video: detector on keyframes, optical flow in between")
+    parser.add_argument("--track_interval_min", default=1, type=int, help="video --track: frames between detector runs, lower bound")
+    parser.add_argument("--track_interval_max", default=10, type=int)
+    parser.add_argument("--track_min_conf", default=0.5, type=float, help="video --track: re-detect when a box keeps less of its flow points")
+    parser.add_argument("--track_motion", default=0.05, type=float, help="video --track: per frame shift / box size that halves the interval")
+    parser.add_argument("--roi_size", default=0, type=int, help="video: input size of the crop around the last hands, 0 full frame only")
+    parser.add_argument("--roi_full_interval", default=10, type=int, help="video --roi_size: frames between full frame passes")
+    parser.add_argument("--roi_expand", default=2., type=float, help="video --roi_size: crop side / longer side of the hands' union box")
+    parser.add_argument("--motion_gate", default="", choices=["", "diff", "gmm"], help="video: skip the detector on static frames")
+    parser.add_argument("--gate_width", default=80, type=int, help="video --motion_gate: width of the foreground mask")
+    parser.add_argument("--gate_area", default=0.005, type=float, help="video --motion_gate: foreground share that runs the detector")
+    parser.add_argument("--gate_diff", default=25, type=int, help="video --motion_gate diff: gray level change counted as motion")
+    parser.add_argument("--gate_roi", default=False, action="store_true", help="video --motion_gate: detect on the motion region only")
+    parser.add_argument("--infer_batch", default=16, type=int, help="batch: model batch size for keras / pb")
+    parser.add_argument("--infer_workers", default=4, type=int, help="batch: decode threads, or tflite interpreter processes")
+    parser.add_argument("--detections_out", default="", help="batch: float32 rows [img_id, x1, y1, x2, y2, score, cid], empty is off")
+    parser.add_argument("--render_dir", default="", help="batch: write images with boxes here, empty is off")
+
+    # ------- serve ------------------
+    parser.add_argument("--serve_address", default="127.0.0.1:8765", help="host:port or unix socket path")
+    parser.add_argument("--batch_window", default=5., type=float, help="serve: ms to wait for more requests after the first")
+    parser.add_argument("--serve_batch", default=16, type=int, help="serve: max requests per model batch")
+    parser.add_argument("--clients", default=4, type=int, help="loadgen.py: concurrent clients")
+    parser.add_argument("--requests", default=100, type=int, help="loadgen.py: requests per client")
+    parser.add_argument("--raw_frames", default=False, action="store_true", help="loadgen.py: send raw bgr instead of jpeg")
 
     # ------- freezon ----------------
     parser.add_argument("--tflite", default=False, action="store_true", help="use tflite")
+    parser.add_argument("--quantize", choices=["none", "dynamic", "float16", "int8", "uint8"], default="dynamic", help="tflite quantization")
+    parser.add_argument("--calib_num", default=200, type=int, help="test images used to calibrate int8 / uint8")
+    parser.add_argument("--tflite_dynamic", default=False, action="store_true", help="keep the tflite input resizable")
+    parser.add_argument("--tflite_cache", default=4, type=int, help="allocated tflite interpreters kept, one per input size")
+    parser.add_argument("--warmup_sizes", nargs='*', default=[], type=int, help="tflite input sizes allocated at start, default test_input")
+    parser.add_argument("--export_nms", default=False, action="store_true", help="bake decode, score threshold and nms into the exported graph")
+    parser.add_argument("--max_output", default=50, type=int, help="max boxes returned by an export_nms graph")
+    parser.add_argument("--nms_thres", default=0.3, type=float)
+
+    # ------- profiling --------------
+    parser.add_argument("--profile", default=False, action="store_true", help="record utils.profiling spans, report at exit")
+    parser.add_argument("--profile_out", default="", help="flush spans here every profile_interval seconds")
+    parser.add_argument("--profile_format", choices=["prom", "jsonl"], default="prom")
+    parser.add_argument("--profile_interval", default=10., type=float)
+
+    # ------- kmeans anchors ---------
+    parser.add_argument("--kmeans_out", default="anchors.txt", help="kmeans.py: anchors file, load it with --anchors_path")
+    parser.add_argument("--kmeans_per_stride", default=False, action="store_true", help="kmeans.py: own anchors per stride instead of shared ones")
+    parser.add_argument("--kmeans_scale", default=1., type=float, help="kmeans.py: annotation pixels -> input pixels, e.g. 224 / 640")
+    parser.add_argument("--kmeans_restarts", default=8, type=int)
+    parser.add_argument("--kmeans_workers", default=4, type=int, help="kmeans.py: processes running the restarts")
+    parser.add_argument("--kmeans_batch", default=100000, type=int, help="kmeans.py: mini-batch size once there are more boxes, 0 full batch")
+
+    # ------- benchmark --------------
+    parser.add_argument("--bench", nargs='*', default=["label"], help="benchmarks run by benchmark.py")
+    parser.add_argument("--bench_repeat", default=20, type=int)
+    parser.add_argument("--bench_workers", default=3, type=int)
+    parser.add_argument("--quant_models", nargs='*', default=[], help="benchmark.py quant: tflite files to compare")
+    parser.add_argument("--bench_models", nargs='*', default=[], help="benchmark.py infer: checkpoints / pb / tflite, default pretrain_model")
+    parser.add_argument("--bench_sizes", nargs='*', default=[], type=int, help="benchmark.py infer: input sizes, default test_input")
+    parser.add_argument("--bench_batches", nargs='*', default=[1], type=int)
+    parser.add_argument("--bench_images", default=32, type=int, help="benchmark.py infer: first images of eval_ano")
+    parser.add_argument("--bench_warmup", default=1, type=int, help="benchmark.py infer: untimed passes over the images")
+    parser.add_argument("--bench_out", default="bench.json")
+    parser.add_argument("--bench_baseline", default="", help="benchmark.py infer: json from an earlier run, flag p50 regressions")
+    parser.add_argument("--bench_tolerance", default=0.1, type=float)
 
     args = parser.parse_args()
+    if args.canny and args.edge_channel:
+        parser.error("--canny and --edge_channel both add the edge channel, pick one")
     # extra params
     setattr(args, "class_num", len(args.categories))
     setattr(args, "channel", 4 if args.canny else 3)  # rgb == 3 ; cany = (rgn + cany)
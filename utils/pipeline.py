@@ -0,0 +1,166 @@
+import time
+import threading
+import numpy as np
+
+
+class LatestQueue(object):
+    """
+    bounded queue where the newest item wins, a put on a full queue drops the
+    oldest item instead of blocking the producer. None closes the queue.
+    """
+
+    def __init__(self, maxsize=1):
+        self.maxsize = maxsize
+        self.items = []
+        self.dropped = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, item):
+        with self.cond:
+            if item is None:
+                self.closed = True
+            else:
+                if len(self.items) >= self.maxsize:
+                    self.items.pop(0)
+                    self.dropped += 1
+                self.items.append(item)
+            self.cond.notify_all()
+
+    def get(self):
+        '''
+            blocks until an item is ready, None once closed and drained
+        '''
+        with self.cond:
+            while not self.items and not self.closed:
+                self.cond.wait()
+            return self.items.pop(0) if self.items else None
+
+
+class LatencyStat(object):
+    def __init__(self, name):
+        self.name = name
+        self.costs = []
+
+    def add(self, cost):
+        self.costs.append(cost)
+
+    def report(self):
+        if not self.costs:
+            return "%s: -" % self.name
+        costs = np.array(self.costs) * 1000
+        return "%s: n %d mean %.1fms p50 %.1fms p99 %.1fms" % (self.name, len(costs), costs.mean(),
+            np.percentile(costs, 50), np.percentile(costs, 99))
+
+
+class Stage(threading.Thread):
+    """
+    worker thread: item = func(item) from inq to outq, timing every call.
+    func returns None to drop an item, the end of inq is passed on to outq.
+    """
+
+    def __init__(self, name, func, inq, outq):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self.func = func
+        self.inq, self.outq = inq, outq
+        self.stat = LatencyStat(name)
+
+    def run(self):
+        try:
+            while True:
+                item = self.inq.get()
+                if item is None:
+                    break
+                start = time.time()
+                item = self.func(item)
+                self.stat.add(time.time() - start)
+                if item is not None:
+                    self.outq.put(item)
+        finally:
+            self.outq.put(None)
+
+
+class Frame(object):
+    def __init__(self, idx, org_img):
+        self.idx = idx
+        self.org_img = org_img
+        self.img = None
+        self.meta = None
+        self.bboxes = []
+        self.capture_time = time.time()
+
+
+class VideoPipeline(object):
+    """
+    capture -> preprocess -> inference -> render, capture / preprocess / inference
+    on their own threads joined by LatestQueue(1), render on the caller thread
+    (cv2.imshow wants the main thread). Stale frames are dropped at every queue,
+    so display lags capture by one frame per stage at most.
+
+    :param cap: cv2.VideoCapture like object
+    :param realtime: pace reads at the source fps, a video file then behaves like a camera
+    """
+
+    def __init__(self, cap, preprocess, infer, render, realtime=True):
+        self.cap = cap
+        self.fps = cap.get(5) if realtime else 0  # cv2.CAP_PROP_FPS
+        self.render = render
+        self.queues = [LatestQueue(1) for _ in range(3)]
+        self.capture_stat = LatencyStat("capture")
+        self.render_stat = LatencyStat("render")
+        self.e2e_stat = LatencyStat("capture->display")
+        self.captured = self.displayed = 0
+        self.stopped = False
+        self.capturer = threading.Thread(target=self.capture, daemon=True)
+        self.stages = [
+            Stage("preprocess", preprocess, self.queues[0], self.queues[1]),
+            Stage("inference", infer, self.queues[1], self.queues[2]),
+        ]
+
+    def capture(self):
+        start = time.time()
+        try:
+            while not self.stopped:
+                read_start = time.time()
+                ret, org_img = self.cap.read()
+                if not ret:
+                    break
+                self.capture_stat.add(time.time() - read_start)
+                self.queues[0].put(Frame(self.captured, org_img))
+                self.captured += 1
+                if self.fps > 0:
+                    time.sleep(max(start + self.captured / self.fps - time.time(), 0))
+        finally:
+            self.queues[0].put(None)
+
+    def run(self):
+        self.start_time = time.time()
+        self.capturer.start()
+        for stage in self.stages:
+            stage.start()
+
+        while True:
+            frame = self.queues[2].get()
+            if frame is None:
+                break
+            start = time.time()
+            keep = self.render(frame)
+            self.render_stat.add(time.time() - start)
+            self.e2e_stat.add(time.time() - frame.capture_time)
+            self.displayed += 1
+            if keep is False:
+                self.stopped = True
+                break
+
+        self.stopped = True
+        self.capturer.join()
+        return self.report()
+
+    def report(self):
+        cost = time.time() - self.start_time
+        lines = [stat.report() for stat in [self.capture_stat] + [s.stat for s in self.stages] +
+                 [self.render_stat, self.e2e_stat]]
+        lines.append("captured %d displayed %d dropped %s fps %.1f" % (self.captured, self.displayed,
+            [q.dropped for q in self.queues], self.displayed / max(cost, 1e-6)))
+        print("\n".join(lines))
+        return lines
@@ -0,0 +1,208 @@
+import os
+import json
+import math
+import time
+import atexit
+import threading
+
+'''
+    named spans with per-thread histograms:
+        with span("nms"):
+            ...
+        @profiled("postprocess_boxes")
+        def postprocess_boxes(...)
+    every thread records into its own histograms, the only shared step is registering a new
+    thread. Disabled (the default) span() hands back one shared no-op object.
+    enable(path) flushes every interval seconds, prom writes a prometheus textfile,
+    jsonl appends one line of percentiles per flush.
+'''
+_enabled = False
+_local = threading.local()
+_registry = []
+_registry_lock = threading.Lock()
+
+
+class Histogram(object):
+    """
+    log2 buckets with SUB steps per octave, from 2**MIN_EXP (~1us) to 2**MAX_EXP seconds
+    """
+    SUB = 4
+    MIN_EXP = -20
+    MAX_EXP = 8
+    SIZE = (MAX_EXP - MIN_EXP) * SUB + 1
+
+    def __init__(self):
+        self.counts = [0] * self.SIZE
+        self.total = 0.
+        self.count = 0
+
+    def add(self, cost):
+        index = 0
+        if cost > 0:
+            mantissa, exp = math.frexp(cost)
+            index = min(max((exp - self.MIN_EXP - 1) * self.SUB + int((mantissa - 0.5) * 2 * self.SUB) + 1, 0),
+                        self.SIZE - 1)
+        self.counts[index] += 1
+        self.total += cost
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+        self.count += other.count
+
+    @classmethod
+    def bound(cls, index):
+        '''
+            upper bound in seconds of bucket index
+        '''
+        if index == cls.SIZE - 1:
+            return float("inf")
+        exp, step = divmod(index, cls.SUB)
+        return 2. ** (cls.MIN_EXP + exp) * (1 + 1. * step / cls.SUB)
+
+    def percentile(self, q):
+        if self.count == 0:
+            return 0.
+        rank, seen = q / 100. * self.count, 0
+        for index, num in enumerate(self.counts):
+            seen += num
+            if seen >= rank and num:
+                return min(self.bound(index), self.bound(self.SIZE - 2))
+        return self.bound(self.SIZE - 2)
+
+
+class Span(object):
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start)
+
+
+class NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_null_span = NullSpan()
+
+
+def record(name, cost):
+    hists = getattr(_local, "hists", None)
+    if hists is None:
+        hists = _local.hists = {}
+        with _registry_lock:
+            _registry.append(hists)
+    hist = hists.get(name)
+    if hist is None:
+        hist = hists[name] = Histogram()
+    hist.add(cost)
+
+
+def span(name):
+    return Span(name) if _enabled else _null_span
+
+
+def profiled(name=None):
+    '''
+        decorator, one span per call named after the function by default
+    '''
+    def wrap(func):
+        span_name = name or func.__name__
+
+        def __wrap__(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with Span(span_name):
+                return func(*args, **kwargs)
+        __wrap__.__name__ = func.__name__
+        __wrap__.__doc__ = func.__doc__
+        return __wrap__
+    return wrap
+
+
+def snapshot():
+    '''
+        histograms of all threads merged by span name
+    '''
+    with _registry_lock:
+        thread_hists = list(_registry)
+    merged = {}
+    for hists in thread_hists:
+        for name, hist in list(hists.items()):
+            merged.setdefault(name, Histogram()).merge(hist)
+    return merged
+
+
+def summary(hists=None):
+    hists = snapshot() if hists is None else hists
+    return {name: {"count": hist.count, "mean_ms": 1000. * hist.total / max(hist.count, 1),
+                   "p50_ms": 1000. * hist.percentile(50), "p90_ms": 1000. * hist.percentile(90),
+                   "p99_ms": 1000. * hist.percentile(99)} for name, hist in sorted(hists.items())}
+
+
+def report():
+    lines = ["%s: n %d mean %.2fms p50 %.2fms p90 %.2fms p99 %.2fms" % (name, s["count"], s["mean_ms"],
+        s["p50_ms"], s["p90_ms"], s["p99_ms"]) for name, s in summary().items()]
+    print("\n".join(lines))
+    return lines
+
+
+def flush(path, fmt="prom"):
+    hists = snapshot()
+    if fmt == "jsonl":
+        with open(path, "a") as fd:
+            fd.write(json.dumps({"ts": time.time(), "spans": summary(hists)}) + "\n")
+        return
+
+    lines = ["# TYPE gesture_span_seconds histogram"]
+    for name, hist in sorted(hists.items()):
+        seen = 0
+        for index, num in enumerate(hist.counts[:-1]):
+            seen += num
+            lines.append('gesture_span_seconds_bucket{span="%s",le="%.9g"} %d' % (name, Histogram.bound(index), seen))
+        lines.append('gesture_span_seconds_bucket{span="%s",le="+Inf"} %d' % (name, hist.count))
+        lines.append('gesture_span_seconds_sum{span="%s"} %.9g' % (name, hist.total))
+        lines.append('gesture_span_seconds_count{span="%s"} %d' % (name, hist.count))
+    # textfile collectors must never see a half written file
+    with open(path + ".tmp", "w") as fd:
+        fd.write("\n".join(lines) + "\n")
+    os.replace(path + ".tmp", path)
+
+
+def enable(path="", fmt="prom", interval=10.):
+    global _enabled
+    _enabled = True
+    if not path:
+        return
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            flush(path, fmt)
+    threading.Thread(target=loop, daemon=True).start()
+    atexit.register(flush, path, fmt)
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def configure(params):
+    '''
+        --profile on: spans recorded, --profile_out set: periodic flush
+    '''
+    if params.profile or params.profile_out:
+        enable(params.profile_out, params.profile_format, params.profile_interval)
+        atexit.register(report)
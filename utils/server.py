@@ -0,0 +1,210 @@
+import json
+import time
+import socket
+import struct
+import threading
+import socketserver
+from collections import Counter, deque
+import cv2
+import numpy as np
+from utils.utils import letterbox
+
+'''
+    local detection server, one request / response per frame over tcp or unix socket:
+        request   HEADER (kind, h, w, size) + payload, kind is KIND_JPEG / KIND_RAW (uint8 h*w*3 bgr)
+                  or KIND_STATS (no payload)
+        response  COUNT n + n * 6 float32 (x1, y1, x2, y2, score, cid), for stats COUNT size + json
+                  a request that fails gets COUNT ERROR + COUNT size + utf8 message, the connection stays open
+    requests arriving inside batch_window are run as one model batch by MicroBatcher.
+'''
+HEADER = struct.Struct("!BIII")
+COUNT = struct.Struct("!I")
+KIND_JPEG, KIND_RAW, KIND_STATS = 0, 1, 2
+ERROR = 0xFFFFFFFF
+
+
+def parse_address(address):
+    '''
+        "host:port" -> tcp, anything else is a unix socket path
+    '''
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit():
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+def recv_exact(sock, size):
+    buf = bytearray(size)
+    view, got = memoryview(buf), 0
+    while got < size:
+        num = sock.recv_into(view[got:], size - got)
+        if num == 0:
+            raise EOFError("connection closed")
+        got += num
+    return buf
+
+
+class MicroBatcher(object):
+    """
+    collects requests for up to window seconds (or max_batch of them) after the first
+    one arrives, then runs them with one run_batch(imgs, org_shapes, metas) call,
+    metas are the letterbox (scale, dw, dh) of each image.
+    """
+
+    def __init__(self, run_batch, window=0.005, max_batch=16):
+        self.run_batch = run_batch
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = deque()
+        self.cond = threading.Condition()
+        self.batch_hist = Counter()
+        self.latencies = deque(maxlen=10000)
+        self.max_depth = 0
+        self.requests = 0
+        self.worker = threading.Thread(target=self.loop, daemon=True)
+        self.worker.start()
+
+    def submit(self, img, org_shape, meta):
+        slot = {"event": threading.Event(), "start": time.time()}
+        with self.cond:
+            self.pending.append((img, org_shape, meta, slot))
+            self.max_depth = max(self.max_depth, len(self.pending))
+            self.cond.notify()
+        slot["event"].wait()
+        if "error" in slot:
+            raise slot["error"]
+        return slot["bboxes"]
+
+    def take(self):
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+            deadline = self.pending[0][-1]["start"] + self.window
+            while len(self.pending) < self.max_batch and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+            return [self.pending.popleft() for _ in range(min(self.max_batch, len(self.pending)))]
+
+    def loop(self):
+        while True:
+            batch = self.take()
+            imgs, org_shapes, metas, slots = zip(*batch)
+            try:
+                results = self.run_batch(np.array(imgs, dtype=np.float32), org_shapes, metas)
+                if len(results) != len(slots):
+                    raise ValueError("run_batch returned %d results for %d images" % (len(results), len(slots)))
+            except Exception as e:
+                results = [None] * len(slots)
+                for slot in slots:
+                    slot["error"] = e
+            done = time.time()
+            with self.cond:
+                self.batch_hist[len(batch)] += 1
+                self.requests += len(batch)
+                self.latencies.extend([done - slot["start"] for slot in slots])
+            for slot, bboxes in zip(slots, results):
+                slot["bboxes"] = bboxes
+                slot["event"].set()
+
+    def stats(self):
+        with self.cond:
+            latencies = np.array(self.latencies) * 1000
+            return {
+                "requests": self.requests,
+                "queue_depth": len(self.pending),
+                "max_queue_depth": self.max_depth,
+                "batch_sizes": {str(k): v for k, v in sorted(self.batch_hist.items())},
+                "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            }
+
+
+class DetectionHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        while True:
+            try:
+                kind, h, w, size = HEADER.unpack(recv_exact(self.request, HEADER.size))
+                payload = recv_exact(self.request, size) if size else b""
+            except (EOFError, ConnectionResetError):
+                return
+
+            if kind == KIND_STATS:
+                reply = json.dumps(server.batcher.stats()).encode()
+                self.request.sendall(COUNT.pack(len(reply)) + reply)
+                continue
+            try:
+                bboxes = self.detect(kind, h, w, payload)
+            except Exception as e:
+                reply = ("%s: %s" % (type(e).__name__, e)).encode()
+                self.request.sendall(COUNT.pack(ERROR) + COUNT.pack(len(reply)) + reply)
+                continue
+            self.request.sendall(COUNT.pack(len(bboxes)) + bboxes.tobytes())
+
+    def detect(self, kind, h, w, payload):
+        server = self.server
+        if kind == KIND_JPEG:
+            org_img = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if org_img is None:
+                raise ValueError("can not decode jpeg payload of %d bytes" % len(payload))
+        elif kind == KIND_RAW:
+            if len(payload) != h * w * 3:
+                raise ValueError("raw payload of %d bytes is not %dx%dx3" % (len(payload), h, w))
+            org_img = np.frombuffer(payload, dtype=np.uint8).reshape(h, w, 3)
+        else:
+            raise ValueError("unknown request kind %d" % kind)
+
+        img, meta = letterbox(org_img, [server.input_size, server.input_size], canny=server.canny)
+        return np.array(server.batcher.submit(img, org_img.shape[:2], meta), dtype=np.float32).reshape(-1, 6)
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def build_server(address, run_batch, input_size, canny=False, window=0.005, max_batch=16):
+    '''
+        run_batch(imgs, org_shapes, metas) -> bboxes per image, see demo.batch_loader
+    '''
+    family, address = parse_address(address)
+    server_cls = ThreadingTCPServer if family == socket.AF_INET else ThreadingUnixServer
+    server = server_cls(address, DetectionHandler)
+    server.batcher = MicroBatcher(run_batch, window, max_batch)
+    server.input_size = input_size
+    server.canny = canny
+    return server
+
+
+class DetectionClient(object):
+    def __init__(self, address):
+        family, address = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(address)
+
+    def detect(self, org_img, jpeg=True):
+        if jpeg:
+            payload = cv2.imencode(".jpg", org_img)[1].tobytes()
+        else:
+            payload = np.ascontiguousarray(org_img, dtype=np.uint8).tobytes()
+        h, w = org_img.shape[:2]
+        self.sock.sendall(HEADER.pack(KIND_JPEG if jpeg else KIND_RAW, h, w, len(payload)) + payload)
+        return self.read_bboxes()
+
+    def read_bboxes(self):
+        [num] = COUNT.unpack(recv_exact(self.sock, COUNT.size))
+        if num == ERROR:
+            [size] = COUNT.unpack(recv_exact(self.sock, COUNT.size))
+            raise RuntimeError("server error: %s" % bytes(recv_exact(self.sock, size)).decode())
+        return np.frombuffer(recv_exact(self.sock, num * 6 * 4), dtype=np.float32).reshape(-1, 6)
+
+    def stats(self):
+        self.sock.sendall(HEADER.pack(KIND_STATS, 0, 0, 0))
+        [num] = COUNT.unpack(recv_exact(self.sock, COUNT.size))
+        return json.loads(bytes(recv_exact(self.sock, num)).decode())
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,101 @@
+import os
+import cv2
+import numpy as np
+from .annotation import AnnotationIndex
+
+'''
+    pre-decoded image shards:
+        shard-00000.bin ... raw uint8 BGR images (h, w, 3) back to back
+        index.npz           per image: path, shard id, byte offset, shape, box offsets
+                            boxes: int32 [m, 5] (x1, y1, x2, y2, cid)
+'''
+class ShardWriter(object):
+    def __init__(self, out_dir, shard_bytes=1 << 30, max_size=None):
+        self.out_dir = out_dir
+        self.shard_bytes = shard_bytes
+        self.max_size = max_size
+        self.paths, self.shard_ids, self.offsets, self.shapes = [], [], [], []
+        self.box_counts, self.boxes = [], []
+        self.shard_id, self.shard_offset, self.fd = -1, 0, None
+        os.makedirs(out_dir, exist_ok=True)
+
+    def next_shard(self):
+        if self.fd is not None:
+            self.fd.close()
+        self.shard_id += 1
+        self.shard_offset = 0
+        self.fd = open(os.path.join(self.out_dir, "shard-%05d.bin" % self.shard_id), "wb")
+
+    def add(self, path, image, boxes):
+        boxes = np.reshape(np.array(boxes, dtype=np.float64), (-1, 5))
+        h, w = image.shape[:2]
+        if self.max_size and max(h, w) > self.max_size:
+            scale = 1.0 * self.max_size / max(h, w)
+            image = cv2.resize(image, (int(w * scale), int(h * scale)))
+            boxes[:, :4] = boxes[:, :4] * scale
+
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        if self.fd is None or (self.shard_offset and self.shard_offset + image.nbytes > self.shard_bytes):
+            self.next_shard()
+        self.fd.write(image.tobytes())
+
+        self.paths.append(path)
+        self.shard_ids.append(self.shard_id)
+        self.offsets.append(self.shard_offset)
+        self.shapes.append(image.shape)
+        self.box_counts.append(len(boxes))
+        self.boxes.append(boxes.astype(np.int32))
+        self.shard_offset += image.nbytes
+
+    def close(self):
+        if self.fd is not None:
+            self.fd.close()
+        np.savez(os.path.join(self.out_dir, "index.npz"),
+            paths=np.array(self.paths),
+            shard_ids=np.array(self.shard_ids, dtype=np.int32),
+            offsets=np.array(self.offsets, dtype=np.int64),
+            shapes=np.reshape(np.array(self.shapes, dtype=np.int32), (-1, 3)),
+            box_offsets=np.concatenate([[0], np.cumsum(self.box_counts)]).astype(np.int64),
+            boxes=np.concatenate(self.boxes + [np.zeros((0, 5), dtype=np.int32)], axis=0))
+
+
+class ShardReader(object):
+    '''
+        zero copy reader, reader[i] -> (uint8 image view, int32 boxes view)
+    '''
+    def __init__(self, shard_dir):
+        index = np.load(os.path.join(shard_dir, "index.npz"))
+        self.paths = index["paths"]
+        self.shard_ids = index["shard_ids"]
+        self.offsets = index["offsets"]
+        self.shapes = index["shapes"]
+        self.box_offsets = index["box_offsets"]
+        self.boxes = index["boxes"]
+        self.shards = [np.memmap(os.path.join(shard_dir, "shard-%05d.bin" % sid), dtype=np.uint8, mode="r")
+                       for sid in range(int(self.shard_ids.max()) + 1 if len(self.shard_ids) else 0)]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, idx):
+        h, w, c = self.shapes[idx]
+        offset = self.offsets[idx]
+        image = self.shards[self.shard_ids[idx]][offset: offset + h * w * c].reshape((h, w, c))
+        boxes = self.boxes[self.box_offsets[idx]: self.box_offsets[idx + 1]]
+        return image, boxes
+
+    def class_hist(self, class_num):
+        return np.bincount(self.boxes[:, 4], minlength=class_num)
+
+
+def pack_annotations(anno_paths, out_dir, max_size=None, shard_bytes=1 << 30):
+    writer = ShardWriter(out_dir, shard_bytes, max_size)
+    index = AnnotationIndex.from_files(anno_paths)
+    for idx in range(len(index)):
+        path = index.path(idx)
+        image = cv2.imread(path)
+        if image is None:
+            raise KeyError("%s does not exist ... " % path)
+        writer.add(path, image, index.sample_boxes(idx))
+    writer.close()
+    print("packed %d images into %s" % (len(writer.paths), out_dir))
@@ -0,0 +1,309 @@
+import time
+import cv2
+import numpy as np
+
+'''
+    detect-then-track for video:
+        the detector runs on keyframes only, boxes in between are carried forward by median flow
+        (pyramidal lucas-kanade on a grid of points inside every box, forward-backward checked).
+    the keyframe interval grows while the tracked boxes still agree with the detector and is
+    halved as soon as boxes move fast or the flow loses its points.
+    roi re-detection: between periodic full frame passes the detector only sees an enlarged
+    crop around the last boxes at a smaller input size.
+    motion gate: frames whose low resolution foreground (frame difference or gmm.GMM) stays
+    under an area threshold reuse the last result without running anything behind the gate.
+'''
+LK_PARAMS = dict(winSize=(15, 15), maxLevel=2, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+
+
+def box_points(box, grid):
+    xs = np.linspace(box[0], box[2], grid + 2)[1:-1]
+    ys = np.linspace(box[1], box[3], grid + 2)[1:-1]
+    return np.stack(np.meshgrid(xs, ys), axis=-1).reshape(-1, 2)
+
+
+def box_iou(boxes1, boxes2):
+    '''
+        (n, >=4) x (m, >=4) -> (n, m)
+    '''
+    boxes1, boxes2 = np.asarray(boxes1)[:, None, :4], np.asarray(boxes2)[None, :, :4]
+    inter = np.clip(np.minimum(boxes1[..., 2:], boxes2[..., 2:]) - np.maximum(boxes1[..., :2], boxes2[..., :2]), 0, None)
+    inter = inter[..., 0] * inter[..., 1]
+    area1 = (boxes1[..., 2] - boxes1[..., 0]) * (boxes1[..., 3] - boxes1[..., 1])
+    area2 = (boxes2[..., 2] - boxes2[..., 0]) * (boxes2[..., 3] - boxes2[..., 1])
+    return inter / np.maximum(area1 + area2 - inter, 1e-6)
+
+
+def median_flow(prev_gray, gray, boxes, grid=6, fb_thres=1.):
+    """
+    moves boxes (n, 6) from prev_gray to gray with one forward and one backward lk call for all boxes.
+
+    :return: moved boxes, confidence per box (share of points passing the forward-backward check),
+             motion per box (center shift / box size)
+    """
+    boxes = np.array(boxes, dtype=np.float32).reshape(-1, 6)
+    conf, motion = np.zeros(len(boxes)), np.zeros(len(boxes))
+    if not len(boxes):
+        return boxes, conf, motion
+
+    points = np.concatenate([box_points(box, grid) for box in boxes]).astype(np.float32).reshape(-1, 1, 2)
+    forward, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, points, None, **LK_PARAMS)
+    backward, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, prev_gray, forward, None, **LK_PARAMS)
+    good = (status.ravel() == 1) & (back_status.ravel() == 1) & \
+           (np.linalg.norm(points - backward, axis=-1).ravel() < fb_thres)
+
+    per_box = grid * grid
+    for i, box in enumerate(boxes):
+        ok = good[i * per_box:(i + 1) * per_box]
+        conf[i] = ok.mean()
+        if ok.sum() < 2:
+            continue
+        src, dst = points[i * per_box:(i + 1) * per_box, 0][ok], forward[i * per_box:(i + 1) * per_box, 0][ok]
+        shift = np.median(dst - src, axis=0)
+
+        # scale change: median ratio of the pairwise point distances
+        pairs = np.triu_indices(len(src), 1)
+        src_dist = np.linalg.norm(src[pairs[0]] - src[pairs[1]], axis=-1)
+        dst_dist = np.linalg.norm(dst[pairs[0]] - dst[pairs[1]], axis=-1)
+        scale = np.median(dst_dist[src_dist > 0] / src_dist[src_dist > 0]) if (src_dist > 0).any() else 1.
+
+        center = (box[:2] + box[2:4]) / 2 + shift
+        half = (box[2:4] - box[:2]) / 2 * scale
+        boxes[i, :2], boxes[i, 2:4] = center - half, center + half
+        motion[i] = np.linalg.norm(shift) / max(half.max() * 2, 1.)
+
+    h, w = gray.shape[:2]
+    boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]], 0, w - 1)
+    boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]], 0, h - 1)
+    return boxes, conf, motion
+
+
+class DetectTracker(object):
+    """
+    detect(org_img) -> bboxes (x1, y1, x2, y2, score, cid) runs on the first frame, every interval
+    frames after, and whenever a tracked box drops under min_conf. With nothing to track the
+    detector runs every min_interval frames so new hands are picked up.
+
+    flow runs on a gray copy resized by scale.
+    interval adapts in [min_interval, max_interval]: +1 after a keyframe where the tracked boxes
+    matched the new detections (iou >= 0.5), halved when a box moves more than max_motion of its
+    size in one frame or when tracking and detection disagree.
+    """
+
+    def __init__(self, detect, min_interval=1, max_interval=10, min_conf=0.5, max_motion=0.05, scale=0.5):
+        self.detect = detect
+        self.scale = scale
+        self.min_interval = max(min_interval, 1)
+        self.max_interval = max(max_interval, self.min_interval)
+        self.min_conf = min_conf
+        self.max_motion = max_motion
+        self.interval = self.min_interval
+        self.since_key = 0
+        self.prev_gray = None
+        self.bboxes = np.zeros((0, 6), dtype=np.float32)
+        self.frames = self.detections = 0
+        self.detect_cpu = self.track_cpu = 0.
+        self.start_time = time.time()
+
+    def keyframe(self, org_img):
+        '''
+            runs the detector, self.bboxes still holds the tracked boxes to compare against
+        '''
+        start = time.process_time()
+        bboxes = np.array(self.detect(org_img), dtype=np.float32).reshape(-1, 6)
+        self.detect_cpu += time.process_time() - start
+        self.detections += 1
+
+        if len(self.bboxes) and len(bboxes):
+            agree = box_iou(self.bboxes, bboxes).max(axis=1).min() >= 0.5
+        else:
+            agree = len(self.bboxes) == len(bboxes)
+        if agree and len(bboxes):
+            self.interval = min(self.interval + 1, self.max_interval)
+        elif not agree:
+            self.interval = max(self.interval // 2, self.min_interval)
+        self.since_key = 0
+        return bboxes
+
+    def step(self, org_img):
+        start = time.process_time()
+        gray = cv2.cvtColor(org_img, cv2.COLOR_BGR2GRAY)
+        if self.scale != 1:
+            gray = cv2.resize(gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        tracked, conf, motion = self.bboxes, np.zeros(0), np.zeros(0)
+        if self.prev_gray is not None and len(self.bboxes):
+            scaled = self.bboxes * np.array([self.scale] * 4 + [1, 1], dtype=np.float32)
+            tracked, conf, motion = median_flow(self.prev_gray, gray, scaled)
+            tracked[:, :4] /= self.scale
+        self.prev_gray = gray
+        self.since_key += 1
+        if len(motion) and motion.max() > self.max_motion:
+            self.interval = max(self.interval // 2, self.min_interval)
+        self.track_cpu += time.process_time() - start
+
+        self.frames += 1
+        due = self.interval if len(self.bboxes) else self.min_interval
+        self.bboxes = tracked
+        if self.frames == 1 or self.since_key >= due or (len(conf) and conf.min() < self.min_conf):
+            self.bboxes = self.keyframe(org_img)
+        return list(self.bboxes)
+
+    def report(self):
+        cost = time.time() - self.start_time
+        detect_cost = self.detect_cpu / max(self.detections, 1)
+        # what running the detector on every frame would have cost
+        full_cpu = detect_cost * self.frames
+        lines = ["frames %d detector calls %d (every %.1f frames, %.1f/s) final interval %d" % (self.frames,
+                     self.detections, self.frames / max(self.detections, 1), self.detections / max(cost, 1e-6),
+                     self.interval),
+                 "cpu detect %.1fms/call track %.1fms/frame total %.2fs vs %.2fs detecting every frame, saved %.0f%%" % (
+                     detect_cost * 1000, self.track_cpu / max(self.frames, 1) * 1000, self.detect_cpu + self.track_cpu,
+                     full_cpu, 100. * (1 - (self.detect_cpu + self.track_cpu) / max(full_cpu, 1e-6)))]
+        print("\n".join(lines))
+        return lines
+
+
+def roi_window(bboxes, shape, expand=2., min_side=0):
+    '''
+        square crop (x0, y0, x1, y1) around the union of bboxes, expand times its longer side,
+        shifted to stay inside the frame
+    '''
+    h, w = shape[:2]
+    bboxes = np.asarray(bboxes)
+    x1, y1 = bboxes[:, :2].min(axis=0)
+    x2, y2 = bboxes[:, 2:4].max(axis=0)
+    side = int(min(max(max(x2 - x1, y2 - y1) * expand, min_side), w, h))
+    x0 = int(np.clip((x1 + x2 - side) / 2, 0, w - side))
+    y0 = int(np.clip((y1 + y2 - side) / 2, 0, h - side))
+    return x0, y0, x0 + side, y0 + side
+
+
+class RoiDetector(object):
+    """
+    detect(img, input_size, window=None) -> bboxes in img coordinates, a window (x0, y0, x1, y1) runs
+    the model on that crop only (see demo.window_detector). Full frames run at full_size on the first
+    frame, every full_interval frames and whenever the crop comes back empty; other frames run the
+    window around the last boxes at roi_size.
+    """
+
+    def __init__(self, detect, full_size, roi_size=160, full_interval=10, expand=2.):
+        self.detect = detect
+        self.full_size = full_size
+        self.roi_size = roi_size
+        self.full_interval = full_interval
+        self.expand = expand
+        self.since_full = 0
+        self.bboxes = np.zeros((0, 6), dtype=np.float32)
+        self.costs = {"full": [], "roi": []}
+
+    def full(self, org_img):
+        start = time.time()
+        bboxes = np.array(self.detect(org_img, self.full_size), dtype=np.float32).reshape(-1, 6)
+        self.costs["full"].append(time.time() - start)
+        self.since_full = 0
+        return bboxes
+
+    def roi(self, org_img):
+        x0, y0, x1, y1 = roi_window(self.bboxes, org_img.shape, self.expand, self.roi_size)
+        start = time.time()
+        bboxes = np.array(self.detect(org_img, self.roi_size, window=(x0, y0, x1, y1)), dtype=np.float32).reshape(-1, 6)
+        self.costs["roi"].append(time.time() - start)
+        self.since_full += 1
+        return bboxes
+
+    def step(self, org_img):
+        bboxes = []
+        if len(self.bboxes) and self.since_full < self.full_interval:
+            bboxes = self.roi(org_img)
+        if not len(bboxes):
+            bboxes = self.full(org_img)
+        self.bboxes = bboxes
+        return list(bboxes)
+
+    def report(self):
+        lines = []
+        for name, costs in sorted(self.costs.items()):
+            costs = np.array(costs) * 1000
+            lines.append("%s passes %d mean %.1fms p50 %.1fms" % (name, len(costs), costs.mean() if len(costs) else 0,
+                         np.percentile(costs, 50) if len(costs) else 0))
+        print("\n".join(lines))
+        return lines
+
+
+class MotionGate(object):
+    """
+    detect(org_img) -> bboxes only runs when the foreground share of a width pixels wide copy
+    reaches min_area. method "diff": gray pixels that changed more than diff_thres since the
+    last frame that ran detect; "gmm": gmm.GMM foreground, fitted on every gated frame.
+    the mask is 3x3 median filtered so sensor noise does not count as motion.
+    roi: detect(org_img, window=(x0, y0, x1, y1)) only sees the motion bounding box together with
+    the last boxes touching it, expanded; last boxes away from the window are kept.
+    """
+
+    def __init__(self, detect, method="diff", width=80, min_area=0.005, diff_thres=25, roi=False, expand=1.5):
+        self.detect = detect
+        self.method = method
+        self.width = width
+        self.min_area = min_area
+        self.diff_thres = diff_thres
+        self.roi = roi
+        self.expand = expand
+        self.reference = self.gmm = None
+        self.bboxes = np.zeros((0, 6), dtype=np.float32)
+        self.frames = self.runs = 0
+        self.gate_cpu = self.detect_cpu = 0.
+
+    def foreground(self, org_img):
+        h, w = org_img.shape[:2]
+        small = cv2.resize(org_img, (self.width, max(int(h * self.width / w), 1)), interpolation=cv2.INTER_AREA)
+        if self.method == "gmm":
+            if self.gmm is None:
+                from gmm import GMM
+                self.gmm = GMM(small.shape[0], small.shape[1], 5, small.shape[2])
+            # fit marks pixels explained by a background component, a 3x3 median drops the speckle
+            return cv2.medianBlur((~self.gmm.fit(small)).astype(np.uint8), 3) > 0, None
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        if self.reference is None:
+            return np.ones(gray.shape, dtype=bool), gray
+        return cv2.medianBlur((cv2.absdiff(gray, self.reference) > self.diff_thres).astype(np.uint8), 3) > 0, gray
+
+    def run(self, org_img, mask):
+        if not self.roi or not mask.any() or mask.all():
+            return np.array(self.detect(org_img), dtype=np.float32).reshape(-1, 6)
+
+        ys, xs = np.nonzero(mask)
+        scale = org_img.shape[1] / mask.shape[1]
+        motion = np.array([[xs.min(), ys.min(), xs.max() + 1, ys.max() + 1]]) * scale
+        touching = self.bboxes[box_iou(self.bboxes, motion)[:, 0] > 0, :4]
+        x0, y0, x1, y1 = roi_window(np.concatenate([motion, touching]), org_img.shape, self.expand)
+        bboxes = np.array(self.detect(org_img, window=(x0, y0, x1, y1)), dtype=np.float32).reshape(-1, 6)
+        # nothing moved outside the crop, boxes there stay as they were
+        outside = (self.bboxes[:, 2] <= x0) | (self.bboxes[:, 0] >= x1) | (self.bboxes[:, 3] <= y0) | (self.bboxes[:, 1] >= y1)
+        return np.concatenate([self.bboxes[outside], bboxes])
+
+    def step(self, org_img):
+        start = time.process_time()
+        mask, gray = self.foreground(org_img)
+        self.gate_cpu += time.process_time() - start
+
+        self.frames += 1
+        if self.frames > 1 and mask.mean() < self.min_area:
+            return list(self.bboxes)
+
+        start = time.process_time()
+        self.bboxes = self.run(org_img, mask)
+        self.detect_cpu += time.process_time() - start
+        self.runs += 1
+        self.reference = gray
+        return list(self.bboxes)
+
+    def report(self):
+        detect_cost = self.detect_cpu / max(self.runs, 1)
+        full_cpu = detect_cost * self.frames
+        lines = ["gate %s frames %d skipped %d (%.1f%%) gate %.2fms/frame" % (self.method, self.frames,
+                     self.frames - self.runs, 100. * (self.frames - self.runs) / max(self.frames, 1),
+                     self.gate_cpu / max(self.frames, 1) * 1000),
+                 "cpu %.2fs vs %.2fs running every frame, saved %.0f%%" % (self.gate_cpu + self.detect_cpu, full_cpu,
+                     100. * (1 - (self.gate_cpu + self.detect_cpu) / max(full_cpu, 1e-6)))]
+        print("\n".join(lines))
+        return lines
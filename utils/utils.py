@@ -20,30 +20,14 @@ import numpy as np
 import tensorflow.compat.v1 as tf
 from easydict import EasyDict as easydict
 from utils.params import build_args as build_params
+from utils.profiling import profiled
 
 
 def tcost(func):
-    ttimes = {}
-    ttimes.update({func.__name__: {"cost": 0, "cnt": 0}})
-
-    def __log__():
-        mcost = ttimes.get(func.__name__, {})
-        total_cost, total_cnt = mcost.get("cost", 0), mcost.get("cnt", 0)
-        if total_cnt % 10 == 0:
-            print("avg: {}  --- cnt: {}".format(total_cost / total_cnt, total_cnt))
-
-    def __count_one__(dur_time):
-        ttimes[func.__name__]["cost"] += dur_time
-        ttimes[func.__name__]["cnt"] += 1
-
-    def __wrap__(*args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        dur_time = time.time() - start_time
-        __count_one__(dur_time)
-        __log__()
-        return result
-    return __wrap__
+    '''
+        whole call wall time, kept for old callers: now a utils.profiling span named after func
+    '''
+    return profiled()(func)
 
 def config_gpu():
     import tensorflow as tf
@@ -110,6 +94,48 @@ def image_preporcess(image, target_size, gt_boxes=None, canny=False):
         return image_paded, gt_boxes
 
 
+def letterbox(image, target_size, out=None, canny=False):
+    """
+    image_preporcess fast path for inference: resize and pad in uint8, one float32 write at the end.
+    image is left untouched, out is an optional reusable float32 (ih, iw, 3 or 4) buffer.
+    pixels differ from image_preporcess by resize rounding only (uint8 vs float32 resize).
+
+    :return: float32 image, (scale, dw, dh) for postprocess_boxes
+    """
+    ih, iw = target_size
+    h, w = image.shape[:2]
+    scale = min(1.0 * iw / w, 1.0 * ih / h)
+    nw, nh = int(scale * w), int(scale * h)
+    dw, dh = (iw - nw) // 2, (ih - nh) // 2
+
+    image_resized = cv2.cvtColor(cv2.resize(image, (nw, nh)), cv2.COLOR_BGR2RGB)
+    image_paded = cv2.copyMakeBorder(image_resized, dh, ih - nh - dh, dw, iw - nw - dw,
+                                     cv2.BORDER_CONSTANT, value=(128, 128, 128))
+    if out is None:
+        out = np.empty((ih, iw, 4 if canny else 3), dtype=np.float32)
+    out[:, :, :3] = image_paded
+
+    if canny:
+        # mean / std over all channels from per channel moments, no float copy of the image
+        means, stds = cv2.meanStdDev(image_paded)
+        mean = means.mean()
+        std = np.sqrt((stds ** 2 + means ** 2).mean() - mean ** 2)
+        np.subtract(cv2.Canny(image_paded, 100, 200), mean, out=out[:, :, 3], casting="unsafe")
+        out[:, :, 3] /= std
+    return out, (scale, dw, dh)
+
+
+def letterbox_window(image, window, target_size, out=None, canny=False):
+    """
+    letterbox of the window (x0, y0, x1, y1) of image. the returned (scale, dw, dh) maps model
+    coordinates straight to image coordinates, so postprocess_boxes(..., image.shape[:2], ...)
+    clips and filters the boxes of the crop against the whole image.
+    """
+    x0, y0, x1, y1 = window
+    out, (scale, dw, dh) = letterbox(image[y0:y1, x0:x1], target_size, out, canny)
+    return out, (scale, dw - x0 * scale, dh - y0 * scale)
+
+
 def draw_bbox(image, bboxes, classes={}, show_label=True):
     """
     bboxes: [x_min, y_min, x_max, y_max, probability, cls_id] format coordinates.
@@ -178,7 +204,80 @@ def read_pb_return_tensors(graph, pb_file, return_elements):
     return return_elements
 
 
-def nms(bboxes, iou_threshold, sigma=0.3, method='nms'):
+def greedy_nms(bboxes, iou_threshold, sigma=0.3, method='nms', max_output=None):
+    """
+    vectorized greedy nms / soft-nms, same picks and scores as nms_loop / nms2_loop.
+    Candidates live in flat coordinate / score arrays that are compacted with one
+    boolean mask per pick, so each step is one IoU row against the survivors only.
+    Class is ignored, nms2 runs it once per class.
+
+    :param bboxes: (xmin, ymin, xmax, ymax, score, class)
+    :return: picked indices into bboxes in pick order, scores at pick time
+    """
+    assert method in ['nms', 'soft-nms']
+    bboxes = np.asarray(bboxes)
+    num = len(bboxes)
+    max_output = num if max_output is None else max_output
+    index = np.arange(num)
+    x1, y1, x2, y2 = [np.array(bboxes[:, i]) for i in range(4)]
+    areas = (x2 - x1) * (y2 - y1)
+    scores = np.array(bboxes[:, 4])
+    eps = np.finfo(np.float32).eps
+    picks, pick_scores = [], []
+
+    while len(picks) < max_output and len(index) > 0:
+        best = np.argmax(scores)
+        picks.append(index[best])
+        pick_scores.append(scores[best])
+
+        inter_w = np.maximum(np.minimum(x2[best], x2) - np.maximum(x1[best], x1), 0.0)
+        inter_h = np.maximum(np.minimum(y2[best], y2) - np.maximum(y1[best], y1), 0.0)
+        inter_area = inter_w * inter_h
+        iou = np.maximum(1.0 * inter_area / (areas[best] + areas - inter_area), eps)
+
+        if method == 'nms':
+            scores = np.where(iou > iou_threshold, 0.0, scores)
+        else:
+            scores = scores * np.exp(-(1.0 * iou ** 2 / sigma))
+        keep = scores > 0.
+        keep[best] = False
+        index, x1, y1, x2, y2, areas, scores = [v[keep] for v in (index, x1, y1, x2, y2, areas, scores)]
+
+    return np.array(picks, dtype=np.int64), np.array(pick_scores, dtype=bboxes.dtype)
+
+
+def nms(bboxes, iou_threshold, sigma=0.3, method='nms', max_output=None):
+    """
+    :param bboxes: (xmin, ymin, xmax, ymax, score, class)
+
+    Note: soft-nms, https://arxiv.org/pdf/1704.04503.pdf
+          https://github.com/bharatsingh430/soft-nms
+    """
+    if len(bboxes) == 0:
+        return []
+    picks, scores = greedy_nms(bboxes, iou_threshold, sigma, method, max_output=max_output)
+    best_bboxes = np.array(bboxes[picks])
+    best_bboxes[:, 4] = scores
+    return list(best_bboxes)
+
+def nms2(bboxes, iou_threshold, sigma=0.3, method='nms', max_output=None):
+    """
+    per class nms, grouped by class like nms2_loop, max_output caps each class
+    :param bboxes: (xmin, ymin, xmax, ymax, score, class)
+    """
+    best_bboxes = []
+    for cls in list(set(bboxes[:, 5])):
+        best_bboxes += nms(bboxes[bboxes[:, 5] == cls], iou_threshold, sigma, method, max_output)
+    return best_bboxes
+
+def batch_nms(batch_bboxes, iou_threshold, sigma=0.3, method='nms', per_class=False, max_output=None):
+    """
+    nms / nms2 for a batch of images, batch_bboxes: list of (n, 6) arrays
+    """
+    func = nms2 if per_class else nms
+    return [func(bboxes, iou_threshold, sigma, method, max_output) for bboxes in batch_bboxes]
+
+def nms_loop(bboxes, iou_threshold, sigma=0.3, method='nms'):
     """
     :param bboxes: (xmin, ymin, xmax, ymax, score, class)
 
@@ -210,7 +309,7 @@ def nms(bboxes, iou_threshold, sigma=0.3, method='nms'):
 
     return best_bboxes
 
-def nms2(bboxes, iou_threshold, sigma=0.3, method='nms'):
+def nms2_loop(bboxes, iou_threshold, sigma=0.3, method='nms'):
     """
     :param bboxes: (xmin, ymin, xmax, ymax, score, class)
 
@@ -248,7 +347,11 @@ def nms2(bboxes, iou_threshold, sigma=0.3, method='nms'):
     return best_bboxes
 
 
-def postprocess_boxes(pred_bbox, org_img_shape, input_size, score_threshold):
+@profiled()
+def postprocess_boxes(pred_bbox, org_img_shape, input_size, score_threshold, meta=None):
+    '''
+        meta: (scale, dw, dh) from letterbox, recomputed from org_img_shape when None
+    '''
 
     valid_scale=[0, np.inf]
     pred_bbox = np.array(pred_bbox)
@@ -262,10 +365,12 @@ def postprocess_boxes(pred_bbox, org_img_shape, input_size, score_threshold):
                                 pred_xywh[:, :2] + pred_xywh[:, 2:] * 0.5], axis=-1)
     # # (2) (xmin, ymin, xmax, ymax) -> (xmin_org, ymin_org, xmax_org, ymax_org)
     org_h, org_w = org_img_shape
-    resize_ratio = min(1.0 * input_size / org_w, 1.0 * input_size / org_h)
-
-    dw = (input_size - resize_ratio * org_w) / 2
-    dh = (input_size - resize_ratio * org_h) / 2
+    if meta is None:
+        resize_ratio = min(1.0 * input_size / org_w, 1.0 * input_size / org_h)
+        dw = (input_size - resize_ratio * org_w) / 2
+        dh = (input_size - resize_ratio * org_h) / 2
+    else:
+        resize_ratio, dw, dh = meta
 
     pred_coor[:, 0::2] = 1.0 * (pred_coor[:, 0::2] - dw) / resize_ratio
     pred_coor[:, 1::2] = 1.0 * (pred_coor[:, 1::2] - dh) / resize_ratio
@@ -289,6 +394,53 @@ def postprocess_boxes(pred_bbox, org_img_shape, input_size, score_threshold):
 
     return np.concatenate([coors, scores[:, np.newaxis], classes[:, np.newaxis]], axis=-1)
 
+def postprocess_boxes_graph(pred_bbox, org_img_shape, input_size, score_threshold, iou_threshold, max_output):
+    """
+    graph version of postprocess_boxes + nms for exported models, single image,
+    only tflite builtin ops (NON_MAX_SUPPRESSION_V4 with fixed size output)
+
+    :param pred_bbox: (n, 5 + class_num) decoded predictions
+    :param org_img_shape: int tensor (h, w) of the original image
+    :param input_size: scalar tensor, letterboxed input side
+    :return: detections (max_output, 6) xmin, ymin, xmax, ymax, score, class, zero padded,
+             valid number of detections
+    """
+    pred_xywh = pred_bbox[:, 0:4]
+    pred_conf = pred_bbox[:, 4]
+    pred_prob = pred_bbox[:, 5:]
+
+    # (1) (x, y, w, h) --> (xmin, ymin, xmax, ymax) -> (xmin_org, ymin_org, xmax_org, ymax_org)
+    org_h = tf.cast(org_img_shape[0], tf.float32)
+    org_w = tf.cast(org_img_shape[1], tf.float32)
+    input_size = tf.cast(input_size, tf.float32)
+    resize_ratio = tf.minimum(input_size / org_w, input_size / org_h)
+    dw = (input_size - resize_ratio * org_w) / 2
+    dh = (input_size - resize_ratio * org_h) / 2
+
+    xmin = (pred_xywh[:, 0] - pred_xywh[:, 2] * 0.5 - dw) / resize_ratio
+    ymin = (pred_xywh[:, 1] - pred_xywh[:, 3] * 0.5 - dh) / resize_ratio
+    xmax = (pred_xywh[:, 0] + pred_xywh[:, 2] * 0.5 - dw) / resize_ratio
+    ymax = (pred_xywh[:, 1] + pred_xywh[:, 3] * 0.5 - dh) / resize_ratio
+
+    # (2) clip, boxes without area are dropped like the scale mask does
+    xmin, ymin = tf.maximum(xmin, 0.), tf.maximum(ymin, 0.)
+    xmax, ymax = tf.minimum(xmax, org_w - 1), tf.minimum(ymax, org_h - 1)
+    valid_mask = tf.logical_and(xmax > xmin, ymax > ymin)
+
+    # (3) score = conf * class prob, score threshold and class agnostic nms like nms()
+    classes = tf.argmax(pred_prob, axis=-1, output_type=tf.int32)
+    scores = pred_conf * tf.reduce_max(pred_prob, axis=-1)
+    scores = tf.where(valid_mask, scores, tf.zeros_like(scores))
+    coors = tf.stack([xmin, ymin, xmax, ymax], axis=-1)
+
+    indices, valid = tf.raw_ops.NonMaxSuppressionV4(boxes=coors, scores=scores,
+        max_output_size=max_output, iou_threshold=iou_threshold, score_threshold=score_threshold,
+        pad_to_max_output_size=True)
+    detections = tf.concat([tf.gather(coors, indices), tf.gather(scores, indices)[:, tf.newaxis],
+                            tf.cast(tf.gather(classes, indices), tf.float32)[:, tf.newaxis]], axis=-1)
+    keep = tf.cast(tf.range(max_output) < valid, tf.float32)[:, tf.newaxis]
+    return detections * keep, valid
+
 def merge_box(bboxes, thres=0.1):
     while(True):
         before = len(bboxes)